@@ -1,26 +1,60 @@
 
+try:
+    from _thread import allocate_lock
+except ImportError:
+    # Threads aren't available on this platform.
+    allocate_lock = None
+
 ###############################################################################
 # Exceptions
 ###############################################################################
 
 class UnexpectedCharacter(Exception):
     def __init__(self, char, idx, matcher):
+        self.char = char
+        self.idx = idx
+        self.matcher = matcher
         super().__init__(
             'Expected {} at position {} but got {}'.format(
                 getattr(matcher, '__name__', matcher), idx, char)
         )
 
+class SchemaMismatch(Exception):
+    def __init__(self, path, expected, event):
+        super().__init__(
+            'Expected {} at path {} but got {}'.format(
+                getattr(expected, '__name__', expected), path, event)
+        )
+
+class InvalidQuery(Exception):
+    def __init__(self, query, idx):
+        super().__init__(
+            'Invalid query {} at position {}'.format(repr(query), idx)
+        )
+
 ###############################################################################
 # Constants
 ###############################################################################
 
 PERIOD = b'.'
 NEGATIVE_SIGN = b'-'
+ESCAPE = b'\\'
+
+# Define the path pattern segment that matches any single object key or array
+# index.
+WILDCARD = '*'
+
+# Define the single-byte bytes objects for all byte values, such that a
+# character can be got from a byte value without allocating a new object.
+BYTE_CHARS = tuple(bytes((i,)) for i in range(256))
 
 # Define the Parser.container_value_context_stack values.
 ARRAY_VALUE_CONTEXT = 'ARRAY_VALUE_CONTEXT'
 OBJECT_VALUE_CONTEXT = 'OBJECT_VALUE_CONTEXT'
 
+# Define the JSON literal values.
+LITERAL_VALUES = {'true': True, 'false': False, 'null': None}
+
 ###############################################################################
 # Matchers
 #
@@ -111,42 +145,676 @@ class Events:
     STRING = 'STRING'
     TRUE = 'TRUE'
 
+# Define the output literals for the non-string/number scalar value events.
+LITERAL_EVENT_BYTES = {
+    Events.ARRAY_VALUE_FALSE: b'false',
+    Events.ARRAY_VALUE_NULL: b'null',
+    Events.ARRAY_VALUE_TRUE: b'true',
+    Events.FALSE: b'false',
+    Events.NULL: b'null',
+    Events.OBJECT_VALUE_FALSE: b'false',
+    Events.OBJECT_VALUE_NULL: b'null',
+    Events.OBJECT_VALUE_TRUE: b'true',
+    Events.TRUE: b'true',
+}
+
 ###############################################################################
 # Helpers
 ###############################################################################
 
 is_digit = lambda c: c.isdigit()
 
+def encode_matcher(matcher):
+    # Return a JSON-serializable representation of an expect_stack element,
+    # i.e. a Matchers attribute name or a 2-element list for an
+    # ( <optional-matcher>, <mandatory-matcher> ) tuple.
+    if isinstance(matcher, tuple):
+        return [encode_matcher(matcher[0]), encode_matcher(matcher[1])]
+    for k, v in Matchers.__dict__.items():
+        if v is matcher or (isinstance(v, bytes) and v == matcher):
+            return k
+    raise AssertionError(matcher)
+
+def decode_matcher(encoded):
+    # Return the expect_stack element represented by an encode_matcher() value.
+    if isinstance(encoded, list):
+        return decode_matcher(encoded[0]), decode_matcher(encoded[1])
+    return getattr(Matchers, encoded)
+
+def encode_path(path, encoding):
+    # Return a copy of the path, or path pattern, with the object keys encoded
+    # as bytes for comparison with raw keys.
+    return [
+        seg.encode(encoding or 'utf-8')
+        if isinstance(seg, str) and seg != WILDCARD else seg
+        for seg in path
+    ]
+
+def match_path_prefix(pattern, path):
+    # Return a bool indicating whether the leading segments of path match the
+    # specified path pattern, where pattern is a path list in the format
+    # accepted by Parser.yield_paths() that may also contain WILDCARD
+    # segments.
+    if len(pattern) > len(path):
+        return False
+    for pattern_seg, path_seg in zip(pattern, path):
+        if pattern_seg != path_seg and pattern_seg != WILDCARD:
+            return False
+    return True
+
+def match_path(pattern, path):
+    # Return a bool indicating whether path exactly matches the path pattern.
+    return len(pattern) == len(path) and match_path_prefix(pattern, path)
+
+###############################################################################
+# Decompression
+#
+# Compressed streams are detected by their leading magic bytes and wrapped in a
+# DecompressingReader that decompresses them in large chunks, so that the
+# Parser's small reads don't each incur the decompressor overhead.
+###############################################################################
+
+# Define the number of leading stream bytes to inspect for magic bytes.
+MAGIC_BYTES_LEN = 6
+
+def get_decompressor_factory(magic):
+    # Return a function that returns a new decompressor object for the
+    # compression format indicated by the magic bytes, or None if the format
+    # is not recognized.
+    is_gzip = magic.startswith(b'\x1f\x8b')
+    if is_gzip or (len(magic) >= 2 and magic[0] == 0x78
+                   and (magic[0] * 256 + magic[1]) % 31 == 0):
+        import zlib
+        if is_gzip:
+            # Use wbits=31 to expect a gzip header and trailer.
+            return lambda: zlib.decompressobj(31)
+        return zlib.decompressobj
+    if magic.startswith(b'BZh'):
+        import bz2
+        return bz2.BZ2Decompressor
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        import lzma
+        return lzma.LZMADecompressor
+    return None
+
+class IdentityDecompressor:
+    # A no-op decompressor for passing through uncompressed data.
+    eof = False
+    unused_data = b''
+
+    def decompress(self, data):
+        return data
+
+class DecompressingReader:
+    # A read-only binary stream that decompresses the data read from an
+    # underlying stream.
+    def __init__(self, stream, new_decompressor, data=b'', chunk_size=65536):
+        # new_decompressor is a function that returns a decompressor object,
+        # and data is any already-read compressed data.
+        self.stream = stream
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.chunk_size = chunk_size
+        # Store compressed data that has yet to be decompressed.
+        self.pending = data
+        # Store the decompressed data and the index of the next byte to read.
+        self.data = b''
+        self.idx = 0
+        self.eof = False
+
+    def fill(self):
+        # Decompress the next chunk of compressed data and append it to the
+        # unread decompressed data.
+        compressed = self.pending or self.stream.read(self.chunk_size)
+        self.pending = b''
+        if self.decompressor.eof:
+            # The data is made up of multiple compressed streams (e.g. a
+            # multi-member gzip file) and the current one has ended, possibly
+            # exactly at the end of the last chunk, so start a new decompressor
+            # for the next one, starting with any data that was left over.
+            compressed = self.decompressor.unused_data + compressed
+            self.decompressor = self.new_decompressor()
+        if not compressed:
+            self.eof = True
+            return
+        decompressed = self.decompressor.decompress(compressed)
+        self.data = self.data[self.idx:] + decompressed
+        self.idx = 0
+
+    def read(self, size=-1):
+        # Return up to size bytes, or all remaining bytes if size is negative.
+        while ((size < 0 or self.idx + size > len(self.data))
+               and not self.eof):
+            self.fill()
+        end = len(self.data) if size < 0 else self.idx + size
+        data = self.data[self.idx:end]
+        self.idx += len(data)
+        return data
+
+    def readinto(self, b):
+        # Read up to len(b) bytes into the bytearray b and return the number
+        # of bytes read.
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def open_decompressed(stream, chunk_size=65536):
+    # Return stream, or a DecompressingReader for stream if it contains gzip,
+    # zlib, bz2, or xz compressed data.
+    magic = b''
+    while len(magic) < MAGIC_BYTES_LEN:
+        data = stream.read(MAGIC_BYTES_LEN - len(magic))
+        if not data:
+            break
+        magic += data
+    new_decompressor = get_decompressor_factory(magic)
+    if new_decompressor is None:
+        seekable = getattr(stream, 'seekable', None)
+        if seekable is not None and seekable():
+            # Rewind the stream and return it as-is.
+            stream.seek(-len(magic), 1)
+            return stream
+        # Pass the already-read bytes and remaining stream through.
+        new_decompressor = IdentityDecompressor
+    return DecompressingReader(stream, new_decompressor, magic, chunk_size)
+
+###############################################################################
+# Read-ahead
+#
+# A ReadAheadReader reads chunks from an underlying stream on a background
+# thread into a bounded queue, so that waiting on slow sources, and any
+# decompression, overlaps with parsing.
+###############################################################################
+
+class ReadAheadReader:
+    # A read-only binary stream that reads up to max_chunks chunks ahead of
+    # the consumer.
+    def __init__(self, stream, chunk_size=65536, max_chunks=2):
+        from queue import Queue
+        from threading import Thread
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # Store the chunks, or the exception raised by the underlying stream,
+        # with an empty chunk indicating the end of the stream.
+        self.queue = Queue(max_chunks)
+        # Store the current chunk and the index of the next byte to read.
+        self.data = b''
+        self.idx = 0
+        self.eof = False
+        self.closed = False
+        self.thread = Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        # Read chunks into the queue until the end of the stream, an error, or
+        # close(), blocking while the queue is full.
+        try:
+            while not self.closed:
+                chunk = self.stream.read(self.chunk_size)
+                self.queue.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.queue.put(e)
+
+    def next_chunk(self):
+        # Wait for the next chunk from the queue and make it current.
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            self.eof = True
+            raise chunk
+        if not chunk:
+            self.eof = True
+        self.data = chunk
+        self.idx = 0
+
+    def read(self, size=-1):
+        # Return up to size bytes, or all remaining bytes if size is negative.
+        # Only block if none of the current chunk remains to be read, such that
+        # fewer than size bytes may be returned before the end of the stream.
+        if size < 0:
+            chunks = [self.data[self.idx:]]
+            while not self.eof:
+                self.next_chunk()
+                chunks.append(self.data)
+            self.idx = len(self.data)
+            return b''.join(chunks)
+        if self.idx >= len(self.data) and not self.eof:
+            self.next_chunk()
+        data = self.data[self.idx:self.idx + size]
+        self.idx += len(data)
+        return data
+
+    def readinto(self, b):
+        # Read up to len(b) bytes into the bytearray b and return the number
+        # of bytes read.
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        # Stop the background thread, discarding any read-ahead chunks, and
+        # wait for it to exit, which, if it's blocked on reading from the
+        # stream, is once that read returns.
+        self.closed = True
+        self.eof = True
+        # Make room for any chunk that's being put, after which fill() will
+        # see the closed flag and return.
+        from queue import Empty
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.thread.join()
+
+###############################################################################
+# Queries
+#
+# Queries are JSONPath-style path expressions, e.g.
+#   $.features[?(@.type == "Feature")].properties.id
+# which are compiled into a list of steps that Parser.query() matches against
+# the document in a single streaming pass. The supported syntax is:
+#   $            the root (optional)
+#   .key         an object key, or ['key'] / ["key"] for keys containing
+#                special characters
+#   [n]          an array index
+#   .* / [*]     any object key or array index
+#   ..           recursive descent, e.g. ..key or ..[*]
+#   [?(<cond>)]  any object key or array index whose value satisfies the
+#                conditions, where <cond> is one or more "&&"-delimited
+#                comparisons of the form:
+#                  @<rel-path> [ <op> <literal> ]
+#                with <rel-path> a (possibly empty) sequence of .key and [n]
+#                segments relative to the value, <op> one of:
+#                == != < <= > >=, and <literal> a JSON string (single or
+#                double quoted), number, true, false, or null. A comparison
+#                without an operator tests for the existence of <rel-path>.
+###############################################################################
+
+# Define the compiled query condition operators.
+QUERY_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    None: lambda a, b: True,
+}
+
+# Define a placeholder for condition operands that are containers.
+CONTAINER_VALUE = object()
+
+# Define a placeholder for condition operands that have not been seen.
+MISSING_VALUE = object()
+
+def compile_query(query):
+    # Compile a query string into a list of steps in the format:
+    #  ( <is-recursive-descent>, <segment>, <conditions-or-None> )
+    # where segment is an object key, array index, or WILDCARD, and conditions
+    # is a list of ( <rel-path>, <op>, <literal> ) tuples.
+    steps = []
+    i = 0
+    query_len = len(query)
+
+    def error():
+        return InvalidQuery(query, i)
+
+    def skip_space():
+        nonlocal i
+        while i < query_len and query[i] == ' ':
+            i += 1
+
+    def parse_name():
+        # Parse a dot-notation object key or wildcard.
+        nonlocal i
+        start = i
+        while i < query_len and query[i] not in '.[ )=!<>&':
+            i += 1
+        if i == start:
+            raise error()
+        name = query[start:i]
+        return WILDCARD if name == WILDCARD else name
+
+    def parse_quoted():
+        # Parse a single or double-quoted string.
+        nonlocal i
+        quote = query[i]
+        end = query.find(quote, i + 1)
+        if end == -1:
+            raise error()
+        value = query[i + 1:end]
+        i = end + 1
+        return value
+
+    def parse_literal():
+        # Parse a condition literal value.
+        nonlocal i
+        if i == query_len:
+            raise error()
+        if query[i] in '\'"':
+            return parse_quoted()
+        start = i
+        while i < query_len and query[i] not in ' &)':
+            i += 1
+        token = query[start:i]
+        if token in LITERAL_VALUES:
+            return LITERAL_VALUES[token]
+        try:
+            return float(token) if '.' in token else int(token)
+        except ValueError:
+            i = start
+            raise error()
+
+    def parse_bracket():
+        # Parse a bracket-notation segment, returning a ( <segment>,
+        # <conditions-or-None> ) tuple.
+        nonlocal i
+        i += 1
+        skip_space()
+        if query.startswith('?(', i):
+            i += 2
+            conditions = parse_conditions()
+            segment = WILDCARD
+        elif query.startswith('*', i):
+            i += 1
+            segment, conditions = WILDCARD, None
+        elif query[i:i + 1] in ('\'', '"'):
+            segment, conditions = parse_quoted(), None
+        else:
+            start = i
+            while i < query_len and query[i].isdigit():
+                i += 1
+            if i == start:
+                raise error()
+            segment, conditions = int(query[start:i]), None
+        skip_space()
+        if not query.startswith(']', i):
+            raise error()
+        i += 1
+        return segment, conditions
+
+    def parse_conditions():
+        # Parse "&&"-delimited conditions up to and including the closing
+        # parenthesis.
+        nonlocal i
+        conditions = []
+        while True:
+            skip_space()
+            if not query.startswith('@', i):
+                raise error()
+            i += 1
+            rel_path = []
+            while i < query_len:
+                if query[i] == '.':
+                    i += 1
+                    rel_path.append(parse_name())
+                elif query[i] == '[':
+                    segment, _conditions = parse_bracket()
+                    if _conditions is not None or segment == WILDCARD:
+                        raise error()
+                    rel_path.append(segment)
+                else:
+                    break
+            skip_space()
+            op = None
+            for _op in ('==', '!=', '<=', '>=', '<', '>'):
+                if query.startswith(_op, i):
+                    op = _op
+                    i += len(_op)
+                    skip_space()
+                    break
+            literal = None if op is None else parse_literal()
+            conditions.append((rel_path, op, literal))
+            skip_space()
+            if query.startswith('&&', i):
+                i += 2
+            elif query.startswith(')', i):
+                i += 1
+                return conditions
+            else:
+                raise error()
+
+    if query.startswith('$'):
+        i = 1
+    while i < query_len:
+        is_descent = query.startswith('..', i)
+        if is_descent:
+            i += 2
+            if query.startswith('[', i):
+                segment, conditions = parse_bracket()
+            else:
+                segment, conditions = parse_name(), None
+        elif query[i] == '.':
+            i += 1
+            segment, conditions = parse_name(), None
+        elif query[i] == '[':
+            segment, conditions = parse_bracket()
+        else:
+            raise error()
+        steps.append((is_descent, segment, conditions))
+    return steps
+
+def encode_query_steps(steps, encoding):
+    # Return a copy of the compile_query() steps with the object keys, as for
+    # encode_path(), and the string literals encoded as bytes, for comparison
+    # with the raw keys and string values of a Parser with encoding=None.
+    def encode_literal(literal):
+        if isinstance(literal, str):
+            return literal.encode(encoding)
+        return literal
+
+    return [
+        (
+            is_descent,
+            encode_path((segment,), encoding)[0],
+            conditions and [
+                (encode_path(rel_path, encoding), op, encode_literal(literal))
+                for rel_path, op, literal in conditions
+            ]
+        )
+        for is_descent, segment, conditions in steps
+    ]
+
+def match_query_steps(steps, path, step_idx=0, path_idx=0, bindings=()):
+    # Yield a tuple of ( <path-length>, <step-index> ) bindings, identifying
+    # the conditional steps that were matched and the length of the path that
+    # they matched, for each way that steps match the whole of path.
+    if step_idx == len(steps):
+        if path_idx == len(path):
+            yield bindings
+        return
+    if path_idx == len(path):
+        return
+    is_descent, segment, conditions = steps[step_idx]
+    if segment == WILDCARD or segment == path[path_idx]:
+        yield from match_query_steps(
+            steps, path, step_idx + 1, path_idx + 1,
+            bindings + ((path_idx + 1, step_idx),) if conditions else bindings
+        )
+    if is_descent:
+        # Try matching the step against a deeper path segment.
+        yield from match_query_steps(
+            steps, path, step_idx, path_idx + 1, bindings
+        )
+
+def match_query_prefix(steps, path, step_idx=0, path_idx=0, strict=False):
+    # Return a bool indicating whether path could be the prefix of a path that
+    # matches steps, or, if strict, of a longer path that matches steps.
+    if path_idx == len(path):
+        return step_idx < len(steps) if strict else True
+    if step_idx == len(steps):
+        return False
+    is_descent, segment, _ = steps[step_idx]
+    if is_descent:
+        return True
+    if segment == WILDCARD or segment == path[path_idx]:
+        return match_query_prefix(
+            steps, path, step_idx + 1, path_idx + 1, strict
+        )
+    return False
+
+class QueryCandidate:
+    # A QueryCandidate tracks the condition operand values of a value that
+    # matched a conditional query step.
+    def __init__(self, path, conditions):
+        self.path = path
+        self.conditions = conditions
+        self.operands = [MISSING_VALUE] * len(conditions)
+        self.closed = False
+
+    def status(self):
+        # Return True if all of the conditions are satisfied, False if any
+        # are not, or None if that can't be determined yet.
+        result = True
+        for (_, op, literal), operand in zip(self.conditions,
+                                             self.operands):
+            if operand is MISSING_VALUE:
+                if self.closed:
+                    return False
+                result = None
+                continue
+            if operand is CONTAINER_VALUE and op is not None:
+                return False
+            try:
+                if not QUERY_OPS[op](operand, literal):
+                    return False
+            except TypeError:
+                # The operand and literal are not comparable.
+                return False
+        return result
+
+def get_rel_path_value(value, rel_path):
+    # Return the value at rel_path in a load()ed value, or MISSING_VALUE.
+    for segment in rel_path:
+        try:
+            if isinstance(value, list) and not isinstance(segment, int):
+                return MISSING_VALUE
+            value = value[segment]
+        except (KeyError, IndexError, TypeError):
+            return MISSING_VALUE
+    if isinstance(value, (list, dict)):
+        return CONTAINER_VALUE
+    return value
+
 ###############################################################################
 # Parser
 ###############################################################################
 
 class Parser:
-    def __init__(self, stream, encoding='utf-8'):
-        self.stream = stream
+    def __init__(self, stream, encoding='utf-8', buffer_size=0,
+                 decompress=False, read_ahead=0, buffer=None):
+        # If encoding is None, string values and object keys are returned as
+        # raw, undecoded bytes.
         self.encoding = encoding
-
-        # Store the current stream char number for reporting the position of
-        # unexpected characters.
-        self.char_num = 0
-        # Store a place to stuff a character that we read from the stream but
-        # need to put back for the next read. next_char() will pop this value
-        # before reading again from the stream, thus providing a sort of 1-byte
-        # lookahead mechanism.
-        self.stuffed_char = None
+        # If buffer_size is non-zero, read the stream in chunks of up to that
+        # many bytes instead of one byte at a time.
+        self.buffer_size = buffer_size
+        # If decompress is True, detect and transparently decompress
+        # compressed streams using open_decompressed().
+        self.decompress = decompress
+        # If read_ahead is non-zero, read up to that many chunks of the stream
+        # ahead on a background thread using a ReadAheadReader.
+        self.read_ahead = read_ahead
+        # If buffer is specified, it's a preallocated bytearray that's reused
+        # to read each chunk using stream.readinto(), and from which characters
+        # are returned as the shared BYTE_CHARS objects, such that reading
+        # doesn't allocate a new chunk or character object. The events, value
+        # generators, and values are allocated as usual. This overrides
+        # buffer_size.
+        self.fixed_buffer = buffer
         # Define a stack to store the Matcher that we expect to match the next
         # character from next_nonspace_char(). A single matcher element is
         # considered to be manadatory and parsing will fail if the matcher
         # fails. A 2-element tuple can be provided with the first element as an
         # optional matcher and the second as a mandatory:
         #   i.e. ( <optional-match>, <mandatory-matcher> )
-        self.expect_stack = [ Matchers.EOF, Matchers.IS_VALUE_START ]
-
+        self.expect_stack = []
         # Define a stack for storing the context of the current container-type
         # (i.e. object value or array value) that we're currently parsing. This
         # is used in order to yield the appropriate event on array/object
         # close.
         self.container_value_context_stack = []
+        self.reset(stream)
+
+    def reset(self, stream):
+        # Reinitialize the parser state in place, reusing the existing stacks,
+        # in order to parse a new stream.
+        prev_stream = getattr(self, 'stream', None)
+        if (isinstance(prev_stream, ReadAheadReader)
+            and prev_stream is not stream):
+            # Stop the previous stream's read-ahead thread.
+            prev_stream.close()
+        if stream is not None and not isinstance(stream, ReadAheadReader):
+            if (self.decompress
+                and not isinstance(stream, DecompressingReader)):
+                stream = open_decompressed(stream)
+            if self.read_ahead:
+                # Read ahead from the possibly decompressed stream so that the
+                # decompression also happens on the background thread.
+                stream = ReadAheadReader(stream, self.buffer_size or 65536,
+                                         self.read_ahead)
+        self.stream = stream
+        # Store the current buffer chunk and the index of the next character to
+        # return from it.
+        self.buffer = b''
+        self.buffer_idx = 0
+        # Store the number of bytes read into the fixed_buffer.
+        self.fixed_buffer_len = 0
+        # Bind the function that next_char() calls, as read_char(1), to read
+        # the next byte, so that the read mode isn't checked for every
+        # character.
+        if self.fixed_buffer is not None:
+            self.read_char = self.read_fixed_buffer_char
+        elif self.buffer_size:
+            self.read_char = self.read_buffered_char
+        else:
+            self.read_char = getattr(stream, 'read', None)
+        # Store the current stream char number for reporting the position of
+        # unexpected characters.
+        self.char_num = 0
+        # Store a place to stuff a character that we read from the stream but
+        # need to put back for the next read. next_char() will pop this value
+        # before reading again from the stream, thus providing a sort of 1-byte
+        # lookahead mechanism.
+        self.stuffed_char = None
+        # Expect a single value followed by the end of the stream.
+        del self.expect_stack[:]
+        self.expect_stack.append(Matchers.EOF)
+        self.expect_stack.append(Matchers.IS_VALUE_START)
+        del self.container_value_context_stack[:]
+        # Define a flag that skip_container() sets to let yield_path_events()
+        # know that the container which it just yielded has been skipped.
+        self.container_skipped = False
+        # Store the value generator for the last event yielded by parse().
+        self.value_gen = None
+        # Store the current yield_path_events() path and, while an
+        # ARRAY_OPEN or OBJECT_OPEN event is being yielded, the node that will
+        # be appended to it for the container.
+        self.path = []
+        self.pending_path_node = None
+        # Store the state of a cooperative load() via step().
+        self.step_gen = None
+        self.step_done = False
+        self.step_result = None
+        self.step_error = None
+        self.step_max_char_num = None
+        self.step_deadline = None
+        self.step_clock = None
+
+    def close(self):
+        # Stop the background thread of any ReadAheadReader that the stream was
+        # wrapped in. The stream itself is owned by the caller and is left
+        # open.
+        if isinstance(self.stream, ReadAheadReader):
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def next_char(self):
         # If there's a stuffed nonspace char, return that and do not increment
@@ -155,11 +823,39 @@ class Parser:
             c = self.stuffed_char
             self.stuffed_char = None
             return c
-        # Return the next byte from the stream and increment char_num.
-        c = self.stream.read(1)
+        # Return the next byte from the buffer or stream and increment
+        # char_num.
+        c = self.read_char(1)
         self.char_num += 1
         return c
 
+    def read_buffered_char(self, size):
+        # Return the next byte from the buffer, reading the next buffer_size
+        # chunk when it's exhausted. At the end of the stream the chunk will
+        # be empty and we'll return Matchers.EOF. size must be 1, and is only
+        # accepted for compatibility with stream.read().
+        if self.buffer_idx >= len(self.buffer):
+            self.buffer = self.stream.read(self.buffer_size)
+            self.buffer_idx = 0
+        idx = self.buffer_idx
+        self.buffer_idx = idx + 1
+        return self.buffer[idx:idx + 1]
+
+    def read_fixed_buffer_char(self, size):
+        # Return the next byte from the fixed_buffer as one of BYTE_CHARS,
+        # reading the next chunk into it when it's exhausted, or Matchers.EOF
+        # at the end of the stream. size must be 1, as for
+        # read_buffered_char().
+        if self.buffer_idx >= self.fixed_buffer_len:
+            num_bytes = self.stream.readinto(self.fixed_buffer)
+            self.fixed_buffer_len = num_bytes or 0
+            self.buffer_idx = 0
+            if not self.fixed_buffer_len:
+                return Matchers.EOF
+        idx = self.buffer_idx
+        self.buffer_idx = idx + 1
+        return BYTE_CHARS[self.fixed_buffer[idx]]
+
     def next_nonspace_char(self):
         # Advance the stream past the next non-whitespace character and return
         # the character, or Matchers.EOF if the stream has been exhausted.
@@ -249,22 +945,194 @@ class Parser:
         yield from self.yield_while(is_digit)
 
     def parse(self):
-        # Start parsing self.stream.
-        while True:
+        # Start parsing self.stream. Parsing stops on EOF or, when parsing
+        # documents via iter_documents(), once the expect_stack is empty.
+        while self.expect_stack:
             # Get the next event.
             event, value_gen, expect = self.next_event()
             # If event is EOF, we've reached the end of the stream.
             if event is Events.EOF:
                 return
+            # If next_event() returned something to expect next, push it now so
+            # that the parser state is consistent while the consumer is
+            # handling the event (e.g. so that skip_container() works).
+            if expect is not None:
+                self.expect_stack.append(expect)
             # Yield the event and any value generator.
+            self.value_gen = value_gen
             yield event, value_gen
             # If a value generator hasn't been fully consumed, drain it.
             if value_gen is not None:
                 for _ in value_gen:
                     pass
-            # If next_event() returned something to expect next, push it.
-            if expect is not None:
-                self.expect_stack.append(expect)
+
+    def iter_documents(self):
+        # Yield a parse() generator for each of the top-level values in a
+        # stream that contains zero or more whitespace-delimited (e.g. NDJSON)
+        # or directly concatenated JSON documents. Each generator is drained
+        # before the next one is yielded. The same parser state and read buffer
+        # is reused for every document, so this must be called on a fresh
+        # Parser.
+        del self.expect_stack[:]
+        while True:
+            # Peek at the next non-whitespace character to check whether
+            # there's another document.
+            c = self.next_nonspace_char()
+            if c == Matchers.EOF:
+                return
+            self.stuff_char(c)
+            # Expect a single value which, once parsed, will leave the
+            # expect_stack empty and thereby end the parse() generator.
+            self.expect_stack.append(Matchers.IS_VALUE_START)
+            parse_gen = self.parse()
+            yield parse_gen
+            for _ in parse_gen:
+                pass
+
+    def validate(self):
+        # Check that the stream contains a single document that parse() would
+        # accept, raising UnexpectedCharacter if not, but without creating any
+        # events, value generators, or values. Return a dict of stats in the
+        # format:
+        #   { 'bytes': <num-bytes>, 'values': <num-values>,
+        #     'max_depth': <max-container-depth> }
+        next_char = self.next_char
+        next_nonspace_char = self.next_nonspace_char
+        # Define a stack of the terminators of the currently-open containers.
+        stack = []
+        num_values = 0
+        max_depth = 0
+        # Store the matcher to report if the next value is invalid, which, as
+        # for parse(), is the mandatory matcher.
+        matcher = Matchers.IS_VALUE_START
+        c = next_nonspace_char()
+        while True:
+            # Validate the value that starts with c.
+            num_values += 1
+            if c == Matchers.ARRAY_OPEN or c == Matchers.OBJECT_OPEN:
+                close = (
+                    Matchers.ARRAY_CLOSE if c == Matchers.ARRAY_OPEN
+                    else Matchers.OBJECT_CLOSE
+                )
+                stack.append(close)
+                if len(stack) > max_depth:
+                    max_depth = len(stack)
+                c = next_nonspace_char()
+                if c != close:
+                    # Validate the first item.
+                    if close == Matchers.ARRAY_CLOSE:
+                        matcher = close
+                    else:
+                        c = self.validate_object_key(c, close)
+                        matcher = Matchers.IS_OBJECT_VALUE_START
+                    continue
+                # The container is empty.
+                stack.pop()
+            elif c == Matchers.STRING_START:
+                self.validate_string()
+            elif Matchers.IS_NUMBER_START(c):
+                # Consume the digits and stuff back the following character.
+                c = next_char()
+                while c.isdigit():
+                    c = next_char()
+                if c == PERIOD:
+                    self.expect(is_digit)
+                    c = next_char()
+                    while c.isdigit():
+                        c = next_char()
+                self.stuff_char(c)
+            elif c == Matchers.NULL_START:
+                self.expect(b'u')
+                self.expect(b'l')
+                self.expect(b'l')
+            elif c == Matchers.TRUE_START:
+                self.expect(b'r')
+                self.expect(b'u')
+                self.expect(b'e')
+            elif c == Matchers.FALSE_START:
+                self.expect(b'a')
+                self.expect(b'l')
+                self.expect(b's')
+                self.expect(b'e')
+            else:
+                raise UnexpectedCharacter(c, self.char_num, matcher)
+
+            # Consume any item separators and container terminators that
+            # follow the value, up until the start of the next value.
+            while True:
+                c = next_nonspace_char()
+                if not stack:
+                    if c != Matchers.EOF:
+                        raise UnexpectedCharacter(c, self.char_num,
+                                                  Matchers.EOF)
+                    return {
+                        'bytes': self.char_num - 1,
+                        'values': num_values,
+                        'max_depth': max_depth,
+                    }
+                close = stack[-1]
+                if c == close:
+                    stack.pop()
+                    continue
+                if c != Matchers.ITEM_SEP:
+                    raise UnexpectedCharacter(c, self.char_num, close)
+                c = next_nonspace_char()
+                if c == close:
+                    # Allow a trailing item separator.
+                    stack.pop()
+                    continue
+                if close == Matchers.ARRAY_CLOSE:
+                    matcher = close
+                else:
+                    c = self.validate_object_key(c, close)
+                    matcher = Matchers.IS_OBJECT_VALUE_START
+                break
+
+    def validate_string(self):
+        # Consume the remainder of a string, as validate() does for
+        # parse_string().
+        if (self.buffer_size and self.fixed_buffer is None
+            and self.stuffed_char is None):
+            # Search the buffer for the terminator rather than reading the
+            # string one character at a time.
+            while True:
+                buffer = self.buffer
+                idx = self.buffer_idx
+                end = buffer.find(Matchers.STRING_TERMINATOR, idx)
+                stop = len(buffer) if end == -1 else end
+                if stop > idx and min(buffer[idx:stop]) <= 0x1f:
+                    # Read one character at a time to find the control
+                    # character.
+                    break
+                self.char_num += stop - idx
+                if end != -1:
+                    self.char_num += 1
+                    self.buffer_idx = end + 1
+                    return
+                self.buffer = self.stream.read(self.buffer_size)
+                self.buffer_idx = 0
+                if not self.buffer:
+                    # Let next_char() return the EOF.
+                    break
+        next_char = self.next_char
+        while True:
+            c = next_char()
+            if c == Matchers.STRING_TERMINATOR:
+                return
+            if c == Matchers.EOF:
+                raise UnexpectedCharacter(c, self.char_num,
+                                          Matchers.STRING_TERMINATOR)
+            if c[0] <= 0x1f:
+                raise UnexpectedCharacter(c, self.char_num, 'NOT_CONTROL_CHAR')
+
+    def validate_object_key(self, c, matcher):
+        # Validate the object key that starts with c and its key / value
+        # separator, and return the first character of the value.
+        if c != Matchers.STRING_START:
+            raise UnexpectedCharacter(c, self.char_num, matcher)
+        self.validate_string()
+        self.expect(Matchers.KV_SEP)
+        return self.next_nonspace_char()
 
     def next_event(self):
         """Attempt to match the next stream character to what's on the top of
@@ -313,33 +1181,11 @@ class Parser:
 
         if matcher == Matchers.ARRAY_CLOSE:
             # Char is an array terminator (i.e. ']')
-            # If container_value_context_stack is non-empty, pop the last
-            # context and expect whatever's appropriate to follow.
-            expect = None
-            if self.container_value_context_stack:
-                context = self.container_value_context_stack.pop()
-                item_sep_matcher = (
-                    Matchers.IS_ARRAY_ITEM_SEP
-                    if context == ARRAY_VALUE_CONTEXT
-                    else Matchers.IS_OBJECT_ITEM_SEP
-                )
-                expect = (item_sep_matcher, self.expect_stack.pop())
-            return Events.ARRAY_CLOSE, None, expect
+            return Events.ARRAY_CLOSE, None, self.pop_container_context()
 
         if matcher == Matchers.OBJECT_CLOSE:
             # Char is an object terminator (i.e. '}').
-            # If container_value_context_stack is non-empty, pop the last
-            # context and expect whatever's appropriate to follow.
-            expect = None
-            if self.container_value_context_stack:
-                context = self.container_value_context_stack.pop()
-                item_sep_matcher = (
-                    Matchers.IS_ARRAY_ITEM_SEP
-                    if context == ARRAY_VALUE_CONTEXT
-                    else Matchers.IS_OBJECT_ITEM_SEP
-                )
-                expect = (item_sep_matcher, self.expect_stack.pop())
-            return Events.OBJECT_CLOSE, None, expect
+            return Events.OBJECT_CLOSE, None, self.pop_container_context()
 
         if matcher == Matchers.IS_OBJECT_KEY_START:
             # Char is the expected object key's opening double-qoute.
@@ -464,6 +1310,175 @@ class Parser:
         # Something went wrong :shrug:
         raise AssertionError(c, matcher)
 
+    def pop_container_context(self):
+        # Call when a container closes. If container_value_context_stack is
+        # non-empty, pop the last context and return whatever's appropriate to
+        # expect next, otherwise return None.
+        if not self.container_value_context_stack:
+            return None
+        context = self.container_value_context_stack.pop()
+        item_sep_matcher = (
+            Matchers.IS_ARRAY_ITEM_SEP
+            if context == ARRAY_VALUE_CONTEXT
+            else Matchers.IS_OBJECT_ITEM_SEP
+        )
+        return item_sep_matcher, self.expect_stack.pop()
+
+    def skip_container(self, sink=None):
+        # Skip the remainder of the array or object whose ARRAY_OPEN or
+        # OBJECT_OPEN event was just yielded by parse(), and update the parser
+        # state as if its terminator had been parsed. The container's bytes
+        # are scanned only to find the matching terminator, so no events are
+        # yielded for (and no validation is performed on) its contents,
+        # including its ARRAY_CLOSE / OBJECT_CLOSE event.
+        # If sink is specified, it's called with successive chunks of the
+        # skipped bytes, up to and including the terminator.
+        # Pop the container contents expectation and get the terminator
+        # matcher.
+        close_matcher = self.expect_stack.pop()[1]
+        depth = 1
+        in_string = False
+        escaped = False
+        if (self.buffer_size and self.fixed_buffer is None
+            and self.stuffed_char is None):
+            # Scan the buffer byte values directly rather than reading one
+            # character at a time, where 0x5c, 0x22, 0x7b, 0x5b, 0x7d, and 0x5d
+            # are ESCAPE, STRING_START / STRING_TERMINATOR, OBJECT_OPEN,
+            # ARRAY_OPEN, OBJECT_CLOSE, and ARRAY_CLOSE respectively.
+            while depth:
+                buffer = self.buffer
+                start = i = self.buffer_idx
+                end = len(buffer)
+                while i < end:
+                    b = buffer[i]
+                    i += 1
+                    if in_string:
+                        if escaped:
+                            escaped = False
+                        elif b == 0x5c:
+                            escaped = True
+                        elif b == 0x22:
+                            in_string = False
+                    elif b == 0x22:
+                        in_string = True
+                    elif b == 0x7b or b == 0x5b:
+                        depth += 1
+                    elif b == 0x7d or b == 0x5d:
+                        depth -= 1
+                        if depth == 0:
+                            break
+                if sink is not None and i > start:
+                    sink(buffer[start:i])
+                self.char_num += i - start
+                self.buffer_idx = i
+                if depth:
+                    self.buffer = self.stream.read(self.buffer_size)
+                    self.buffer_idx = 0
+                    if not self.buffer:
+                        self.char_num += 1
+                        raise UnexpectedCharacter(Matchers.EOF, self.char_num,
+                                                  close_matcher)
+        else:
+            chunk = bytearray() if sink is not None else None
+            while True:
+                c = self.next_char()
+                if c == Matchers.EOF:
+                    raise UnexpectedCharacter(c, self.char_num, close_matcher)
+                if chunk is not None:
+                    chunk += c
+                if in_string:
+                    if c == ESCAPE:
+                        # Skip the escaped character.
+                        c = self.next_char()
+                        if chunk is not None:
+                            chunk += c
+                    elif c == Matchers.STRING_TERMINATOR:
+                        in_string = False
+                elif c == Matchers.STRING_START:
+                    in_string = True
+                elif c == Matchers.OBJECT_OPEN or c == Matchers.ARRAY_OPEN:
+                    depth += 1
+                elif c == Matchers.OBJECT_CLOSE or c == Matchers.ARRAY_CLOSE:
+                    depth -= 1
+                    if depth == 0:
+                        break
+            if chunk is not None:
+                sink(bytes(chunk))
+        # Expect whatever's appropriate to follow the container.
+        expect = self.pop_container_context()
+        if expect is not None:
+            self.expect_stack.append(expect)
+        self.container_skipped = True
+
+    def checkpoint(self):
+        # Return a JSON-serializable dict that describes the parser state
+        # after the last event yielded by parse() or yield_path_events(), from
+        # which parsing can be resumed using restore(). Any unconsumed part of
+        # the last event's value generator is drained and discarded.
+        if self.value_gen is not None:
+            for _ in self.value_gen:
+                pass
+            self.value_gen = None
+        # Rather than saving any stuffed character, rewind the offset to
+        # re-read it on restore.
+        offset = self.char_num
+        if self.stuffed_char is not None:
+            offset -= 1
+        path = list(self.path)
+        if self.pending_path_node is not None and not self.container_skipped:
+            path.append(self.pending_path_node)
+        return {
+            'offset': offset,
+            'expect_stack': [
+                encode_matcher(matcher) for matcher in self.expect_stack
+            ],
+            'container_value_context_stack':
+                list(self.container_value_context_stack),
+            # Replace any empty object indicator with None, and any raw key
+            # bytes with a 1-item list containing the latin-1 decoded string.
+            'path': [
+                None if seg == PERIOD
+                else [seg.decode('latin-1')] if isinstance(seg, bytes)
+                else seg
+                for seg in path
+            ],
+        }
+
+    def restore(self, checkpoint, seek=True):
+        # Restore the parser state from a checkpoint() in order to resume
+        # parsing the same data by calling parse() or yield_path_events(). If
+        # seek is True, seek the stream to the checkpoint offset, otherwise the
+        # stream must already be positioned there (e.g. a re-opened source
+        # that was requested starting at the offset).
+        #
+        # The offset is that of the data that's parsed, so seeking requires
+        # that stream be seekable and that the Parser has not wrapped it in a
+        # DecompressingReader or ReadAheadReader.
+        if seek:
+            seekable = getattr(self.stream, 'seekable', None)
+            if (isinstance(self.stream, (DecompressingReader, ReadAheadReader))
+                or (seekable is not None and not seekable())):
+                raise ValueError(
+                    'restore() can only seek an unwrapped, seekable stream, '
+                    'i.e. not a decompressed or read-ahead one'
+                )
+        self.reset(self.stream)
+        if seek:
+            self.stream.seek(checkpoint['offset'])
+        self.char_num = checkpoint['offset']
+        del self.expect_stack[:]
+        for matcher in checkpoint['expect_stack']:
+            self.expect_stack.append(decode_matcher(matcher))
+        self.container_value_context_stack.extend(
+            checkpoint['container_value_context_stack']
+        )
+        self.path.extend(
+            PERIOD if seg is None
+            else seg[0].encode('latin-1') if isinstance(seg, list)
+            else seg
+            for seg in checkpoint['path']
+        )
+
     def convert(self, event, value):
         # Convert a parsed value to a Python type.
         if (event == Events.ARRAY_VALUE_NULL
@@ -482,6 +1497,9 @@ class Parser:
             or event == Events.OBJECT_VALUE_STRING
             or event == Events.STRING
             or event == Events.OBJECT_KEY):
+            if self.encoding is None:
+                # Return the raw bytes.
+                return b''.join(value)
             return b''.join(value).decode(self.encoding)
         if (event == Events.ARRAY_VALUE_NUMBER
             or event == Events.OBJECT_VALUE_NUMBER
@@ -492,8 +1510,8 @@ class Parser:
         raise NotImplementedError(event, value)
 
     def yield_paths(self, paths):
-        # Yield ( <path>, <value-generator> ) tuples for all specified paths
-        # that exist in the data.
+        # Yield ( <path>, <value> ) tuples for all specified paths that exist
+        # in the data.
         #
         # paths must be an iterable of lists of byte strings and integers in
         # the format:
@@ -501,123 +1519,444 @@ class Parser:
         # Example:
         #   [ 'people', 0, 'first_name' ]
         #
+        # paths may include both a container and paths within it, in which
+        # case the container is built as parsing proceeds, the values within
+        # it are yielded as they're parsed, and the container itself is yielded
+        # once it closes. Containers that are neither at nor lead to a
+        # requested path are skipped.
+        #
+        # The requested object keys are encoded once up front and compared
+        # against the raw key bytes so that keys are only decoded when they're
+        # part of a yielded container.
+        encoded_paths = [encode_path(path, self.encoding) for path in paths]
         # Track the indexes of the paths in paths to be yielded so that we can
         # abort as soon as all requested paths have been yielded.
         unyielded_path_idxs = set(range(len(paths)))
-        # Define the current path stack.
-        path = []
+        # Define a stack of ( <container>, <path-index-or-None> ) tuples for
+        # the containers that are currently being built, i.e. requested
+        # containers that contain other requested paths, and all of the
+        # containers within them.
+        build_stack = []
+
+        def attach(value):
+            # Attach a value to the innermost container being built.
+            container = build_stack[-1][0]
+            if type(container) is list:
+                container.append(value)
+            else:
+                key = self.convert(Events.OBJECT_KEY, (path[-1],))
+                container[key] = value
+
         parse_gen = self.parse()
-        for event, value in parse_gen:
-            if event == Events.OBJECT_OPEN:
-                # An object has opened.
-                # If the current path node is an array index, increment it.
-                if path and isinstance(path[-1], int):
-                    path[-1] += 1
-                # For each unyielded path, attempt to match it against the
-                # current path. If it matches, yield the event and remove the
-                # path index from the unyielded set.
-                yielded = False
-                for i in unyielded_path_idxs:
-                    if path == paths[i]:
-                        # Reset the parser state such that the next call will
-                        # re-yield this same OBJECT_OPEN to make load() work.
-                        yield path, self.load(parse_gen)
+        for event, value, path in self.yield_path_events(parse_gen,
+                                                         raw_keys=True):
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                if build_stack:
+                    container, i = build_stack.pop()
+                    if i is not None:
+                        # A requested container is complete.
+                        yield paths[i], container
                         unyielded_path_idxs.remove(i)
-                        yielded = True
-                        break
-                if not yielded:
-                    # If this container was not already load()ed and yielded,
-                    # Append an empty object indicator to the current path, to
-                    # be overwritten by the next parsed key.
-                    path.append(PERIOD)
+                        if len(unyielded_path_idxs) == 0:
+                            return
                 continue
 
-            elif event == Events.OBJECT_CLOSE:
-                # The object has closed.
-                # Pop it from the current path.
-                path.pop()
+            # Find any unyielded path that matches the current path.
+            match_idx = None
+            for i in unyielded_path_idxs:
+                if path == encoded_paths[i]:
+                    match_idx = i
+                    break
+
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                path_len = len(path)
+                is_prefix = any(
+                    len(encoded_paths[i]) > path_len
+                    and encoded_paths[i][:path_len] == path
+                    for i in unyielded_path_idxs if i != match_idx
+                )
+                if is_prefix and (match_idx is not None or build_stack):
+                    # Build the container while continuing to look for the
+                    # requested paths within it.
+                    container = {} if event == Events.OBJECT_OPEN else []
+                    if build_stack:
+                        attach(container)
+                    build_stack.append((container, match_idx))
+                    continue
+                if is_prefix:
+                    continue
+                if match_idx is None and not build_stack:
+                    # Nothing within the container was requested.
+                    self.skip_container()
+                    continue
+                # Load the container and let yield_path_events() know that
+                # it's been consumed.
+                value = self.load_container(event, None, parse_gen)
+                self.container_skipped = True
+            elif match_idx is not None or build_stack:
+                value = self.convert(event, value)
+            else:
                 continue
 
-            elif event == Events.ARRAY_OPEN:
-                # An array has opened.
+            if build_stack:
+                attach(value)
+            if match_idx is not None:
+                yield paths[match_idx], value
+                unyielded_path_idxs.remove(match_idx)
+                # Abort if all of the requested paths have been yielded.
+                if len(unyielded_path_idxs) == 0:
+                    return
+
+    def load_many(self):
+        # Yield a Python object for each of the documents in a multi-document
+        # stream, as described by iter_documents().
+        for parse_gen in self.iter_documents():
+            yield self.load(parse_gen)
+
+    def yield_path_events(self, parse_gen=None, raw_keys=False):
+        # Yield ( <event>, <value-generator-or-None>, <path> ) tuples for all
+        # container open / close and value events, where path is the location
+        # of the container or value in the format accepted by yield_paths().
+        # Object keys are consumed in order to update the path and are not
+        # themselves yielded, nor are item and key / value separators. If
+        # raw_keys is True, the path keys are the raw, undecoded key bytes.
+        #
+        # Note that the same path list is mutated as parsing proceeds, so copy
+        # it if you need to keep it around.
+        #
+        # skip_container() may be called in response to an ARRAY_OPEN or
+        # OBJECT_OPEN event to skip that container, in which case no
+        # corresponding ARRAY_CLOSE or OBJECT_CLOSE event will be yielded.
+        #
+        # The path continues from self.path, which is empty unless the parser
+        # was restore()d from a checkpoint.
+        if parse_gen is None:
+            parse_gen = self.parse()
+        path = self.path
+        for event, value in parse_gen:
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                # A container has opened.
                 # If the current path node is an array index, increment it.
                 if path and isinstance(path[-1], int):
                     path[-1] += 1
-                # For each unyielded path, attempt to match it against the
-                # current path. If it matches, yield the event and remove the
-                # path index from the unyielded set.
-                yielded = False
-                for i in unyielded_path_idxs:
-                    if path == paths[i]:
-                        # Reset the parser state such that the next call will
-                        # re-yield this same ARRAY_OPEN to make load() work.
-                        yield path, self.load(parse_gen)
-                        unyielded_path_idxs.remove(i)
-                        yielded = True
-                        break
-                if not yielded:
-                    # If this container was not already load()ed and yielded,
-                    # Append an array index of -1 to the current path, to be
-                    # increment on the next parsed array value.
-                    path.append(-1)
-                continue
+                # Unless the container gets skipped, we'll append an empty
+                # object indicator, to be overwritten by the next parsed key,
+                # or an array index of -1, to be incremented on the next parsed
+                # array value.
+                self.container_skipped = False
+                self.pending_path_node = (
+                    PERIOD if event == Events.OBJECT_OPEN else -1
+                )
+                yield event, None, path
+                if not self.container_skipped:
+                    path.append(self.pending_path_node)
+                self.pending_path_node = None
 
-            elif event == Events.ARRAY_CLOSE:
-                # The array has closed.
+            elif event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                # The container has closed.
                 # Pop it from the current path.
                 path.pop()
-                continue
+                yield event, None, path
 
             elif event == Events.OBJECT_KEY:
-                # We parsed an object key.
                 # Overwrite the current path node with the key value.
-                path[-1] = self.convert(Events.OBJECT_KEY, value)
+                path[-1] = (
+                    b''.join(value) if raw_keys else self.convert(event, value)
+                )
 
-            elif (event == Events.ARRAY_VALUE_STRING
-                  or event == Events.ARRAY_VALUE_NUMBER
-                  or event == Events.ARRAY_VALUE_NULL
-                  or event == Events.ARRAY_VALUE_TRUE
-                  or event == Events.ARRAY_VALUE_FALSE):
-                # We parsed an array value.
-                # Increment the current path node array index.
-                path[-1] += 1
-                # For each unyielded path, attempt to match it against the
-                # current path. If it matches, yield the event and remove the
-                # path index from the unyielded set.
-                for i in unyielded_path_idxs:
-                    if path == paths[i]:
-                        yield path, self.convert(event, value)
-                        unyielded_path_idxs.remove(i)
-                        break
+            elif (event == Events.KV_SEP
+                  or event == Events.ARRAY_ITEM_SEP
+                  or event == Events.OBJECT_ITEM_SEP):
+                continue
 
-            elif (event == Events.OBJECT_VALUE_STRING
-                  or event == Events.OBJECT_VALUE_NUMBER
-                  or event == Events.OBJECT_VALUE_NULL
-                  or event == Events.OBJECT_VALUE_TRUE
-                  or event == Events.OBJECT_VALUE_FALSE):
-                # We parsed an object value.
-                # For each unyielded path, attempt to match it against the
-                # current path. If it matches, yield the event and remove the
-                # path index from the unyielded set.
-                for i in unyielded_path_idxs:
-                    if path == paths[i]:
-                        yield path, self.convert(event, value)
-                        unyielded_path_idxs.remove(i)
-                        break
+            else:
+                # We parsed a scalar value.
+                # If it's an array value, increment the current path node array
+                # index.
+                if event.startswith('ARRAY_VALUE_'):
+                    path[-1] += 1
+                yield event, value, path
+
+    def project(self, include=None, exclude=None, parse_gen=None):
+        # Yield the parse() events that describe only those parts of the
+        # document that are selected by the include and exclude path patterns,
+        # which are iterables of path lists in the format accepted by
+        # match_path_prefix().
+        #
+        # If include is specified, only the subtrees at paths matching an
+        # include pattern, and the containers leading to them, are selected.
+        # Subtrees at paths matching an exclude pattern are never selected.
+        # Unselected containers are skipped using skip_container().
+        #
+        # Separator events are not yielded and the OBJECT_KEY value for each
+        # yielded object item is a 1-tuple containing the raw key bytes, such
+        # that the events can be passed directly to Writer.write().
+        #
+        # The pattern keys are encoded once up front and compared against the
+        # raw key bytes, which are never decoded.
+        #
+        # If parse_gen is specified, project the events that it yields.
+        include = (
+            None if include is None
+            else [encode_path(p, self.encoding) for p in include]
+        )
+        exclude = (
+            [] if exclude is None
+            else [encode_path(p, self.encoding) for p in exclude]
+        )
+        for event, value, path in self.yield_path_events(parse_gen,
+                                                         raw_keys=True):
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                # Containers are only left open if selected.
+                yield event, None
+                continue
 
-            # Abort if all of the requested paths have been yielded.
-            if len(unyielded_path_idxs) == 0:
+            is_container = (
+                event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN
+            )
+            selected = not any(match_path_prefix(p, path) for p in exclude)
+            if selected and include is not None:
+                selected = (
+                    any(match_path_prefix(p, path) for p in include)
+                    or (is_container
+                        and any(len(p) > len(path)
+                                and match_path_prefix(p[:len(path)], path)
+                                for p in include))
+                )
+
+            if not selected:
+                if is_container:
+                    self.skip_container()
+                continue
+
+            # If this is an object item, yield its key first.
+            if path and not isinstance(path[-1], int):
+                yield Events.OBJECT_KEY, (path[-1],)
+            yield event, value
+
+    def query(self, query):
+        # Yield ( <path>, <value> ) tuples for all values that match the
+        # specified query string or compile_query() steps.
+        #
+        # Values that match a conditional step are tracked as candidates until
+        # their conditions can be evaluated, and any matching values within
+        # them are buffered until then, which is at the latest when the
+        # candidate closes. Results are therefore not necessarily yielded in
+        # document order. Matching containers within which no deeper match is
+        # possible are load()ed, while the others are built as parsing
+        # proceeds, with the matches within them being yielded too, as for
+        # yield_paths(). Containers that can't contain a match are skipped.
+        #
+        # If the encoding is None, the query's object keys and string literals
+        # are encoded for comparison with the raw keys and string values.
+        steps = compile_query(query) if isinstance(query, str) else query
+        if self.encoding is None:
+            steps = encode_query_steps(steps, 'utf-8')
+        conditional_step_idxs = [
+            i for i, step in enumerate(steps) if step[2] is not None
+        ]
+        # Map the path lengths of the currently-open candidates to a dict of
+        # QueryCandidates keyed by step index.
+        candidates = {}
+        # Define a list of ( <path>, <value>, <candidate-lists> ) tuples for
+        # the matched values whose candidate conditions are not yet resolved,
+        # where candidate-lists is a list of QueryCandidate lists, one per way
+        # that the path matched the query.
+        pending = []
+
+        def resolve(candidate_lists):
+            # Return True if all of the candidates in any list are satisfied,
+            # False if all lists contain an unsatisfied candidate, otherwise
+            # None.
+            result = False
+            for candidate_list in candidate_lists:
+                statuses = [c.status() for c in candidate_list]
+                if all(statuses):
+                    return True
+                if False not in statuses:
+                    result = None
+            return result
+
+        def flush_pending():
+            # Yield and remove any resolved pending results.
+            nonlocal pending
+            if not pending:
                 return
+            unresolved = []
+            for result in pending:
+                status = resolve(result[2])
+                if status:
+                    yield result[0], result[1]
+                elif status is None:
+                    unresolved.append(result)
+            pending = unresolved
+
+        def capture_operands(path, value, is_loaded):
+            # Record value as the operand of any open candidate condition that
+            # refers to it, or, if is_loaded, any value within it.
+            path_len = len(path)
+            captured = False
+            for _candidates in candidates.values():
+                for candidate in _candidates.values():
+                    prefix_len = len(candidate.path)
+                    for i, (rel_path, _, _) in enumerate(candidate.conditions):
+                        full_len = prefix_len + len(rel_path)
+                        if full_len == path_len:
+                            if path[prefix_len:] == rel_path:
+                                candidate.operands[i] = get_rel_path_value(
+                                    value, ()
+                                )
+                                captured = True
+                        elif (is_loaded and full_len > path_len
+                              and rel_path[:path_len - prefix_len]
+                              == path[prefix_len:]):
+                            candidate.operands[i] = get_rel_path_value(
+                                value, rel_path[path_len - prefix_len:]
+                            )
+                            captured = True
+            return captured
+
+        def close_candidates(path_len):
+            # Close the candidates with the specified path length.
+            for candidate in candidates.pop(path_len, {}).values():
+                candidate.closed = True
+
+        def attach(value):
+            # Attach a value to the innermost container being built.
+            container = build_stack[-1][0]
+            if type(container) is list:
+                container.append(value)
+            else:
+                container[path[-1]] = value
+
+        def handle_result(path, value, candidate_lists, status):
+            # Yield or buffer a materialized value according to its status.
+            if status:
+                yield list(path), value
+            elif status is None:
+                pending.append((list(path), value, candidate_lists))
+
+        # Define a stack of ( <container>, <path-length>, <candidate-lists> )
+        # tuples for the containers that are currently being built, i.e.
+        # possible results within which a deeper result may also be found,
+        # and all of the containers within them, where candidate-lists is None
+        # for containers that are not themselves possible results.
+        build_stack = []
+        parse_gen = self.parse()
+        for event, value, path in self.yield_path_events(parse_gen):
+            path_len = len(path)
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                # Close the candidates for the container and its items.
+                close_candidates(path_len + 1)
+                close_candidates(path_len)
+                if build_stack and build_stack[-1][1] == path_len:
+                    container, _, candidate_lists = build_stack.pop()
+                    if build_stack:
+                        attach(container)
+                    if candidate_lists is not None:
+                        yield from handle_result(
+                            path, container, candidate_lists,
+                            resolve(candidate_lists)
+                        )
+                yield from flush_pending()
+                continue
+
+            is_container = (
+                event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN
+            )
+            # Register this value as a candidate for any conditional steps
+            # that it matches.
+            for step_idx in conditional_step_idxs:
+                for _ in match_query_steps(steps[:step_idx + 1], path):
+                    candidates.setdefault(path_len, {})[step_idx] = (
+                        QueryCandidate(list(path), steps[step_idx][2])
+                    )
+                    break
+
+            # Check whether the value is a result.
+            candidate_lists = [
+                [candidates[_path_len][step_idx]
+                 for _path_len, step_idx in bindings]
+                for bindings in match_query_steps(steps, path)
+            ]
+            status = resolve(candidate_lists) if candidate_lists else False
+
+            if not is_container:
+                value = self.convert(event, value)
+                captured = capture_operands(path, value, False)
+            else:
+                captured = capture_operands(path, CONTAINER_VALUE, False)
+            # A condition of the value's own candidates may refer to the
+            # value itself, so re-resolve it.
+            if captured and candidate_lists:
+                status = resolve(candidate_lists)
+
+            if is_container and (status is not False or build_stack):
+                if match_query_prefix(steps, path, strict=True):
+                    # A result may also be found within the container, so
+                    # build it while continuing to look for them.
+                    container = {} if event == Events.OBJECT_OPEN else []
+                    build_stack.append((
+                        container,
+                        path_len,
+                        candidate_lists if status is not False else None
+                    ))
+                    if captured:
+                        yield from flush_pending()
+                    continue
+                # Load the container and let yield_path_events() know that
+                # it's been consumed.
+                value = self.load_container(event, None, parse_gen)
+                self.container_skipped = True
+                if capture_operands(path, value, True) and candidate_lists:
+                    status = resolve(candidate_lists)
+                    captured = True
+            elif is_container:
+                # The container is not a result.
+                if not (path_len in candidates
+                        or match_query_prefix(steps, path)
+                        or any(len(candidate.path) + len(rel_path) > path_len
+                               and rel_path[:path_len - len(candidate.path)]
+                               == path[len(candidate.path):]
+                               for _candidates in candidates.values()
+                               for candidate in _candidates.values()
+                               for rel_path, _, _ in candidate.conditions)):
+                    # Neither the container nor anything within it can be a
+                    # result or condition operand, so skip it.
+                    self.skip_container()
+                if captured:
+                    yield from flush_pending()
+                continue
 
-    def load(self, parse_gen=None):
+            # The value has been materialized.
+            close_candidates(path_len)
+            if build_stack:
+                attach(value)
+            if candidate_lists:
+                yield from handle_result(path, value, candidate_lists, status)
+            if captured:
+                yield from flush_pending()
+
+    def load(self, parse_gen=None, include=None, exclude=None):
         # If parse_gen is specified, parse the single next value in the stream,
         # otherwise parse the entire stream, and return a single Python object,
         # similar to the built-in json.load() / json.loads() behavior.
-        if parse_gen is None:
+        #
+        # If include or exclude path patterns are specified, only the parts of
+        # the document that are selected by them, as for project(), are
+        # loaded, with the unselected containers being skipped, and None is
+        # returned if nothing is selected.
+        if include is not None or exclude is not None:
+            parse_gen = self.project(include, exclude, parse_gen)
+        elif parse_gen is None:
             parse_gen = self.parse()
 
         # Initialize the value based on the first read.
-        event, value = next(parse_gen)
+        for event, value in parse_gen:
+            break
+        else:
+            # Nothing was selected.
+            return None
 
         # If it's a single scalar value, convert and return it.
         if (event == Events.STRING
@@ -627,6 +1966,25 @@ class Parser:
             or event == Events.FALSE):
             return self.convert(event, value)
 
+        return self.load_container(event, value, parse_gen)
+
+    def load_container(self, event, value, parse_gen):
+        # Parse the remainder of the array or object for which parse_gen just
+        # yielded the specified ARRAY_OPEN or OBJECT_OPEN event, or the first
+        # item event, and return it as a Python object.
+        gen = self.iter_load_container(event, value, parse_gen)
+        try:
+            while True:
+                next(gen)
+        except StopIteration as e:
+            return e.value
+
+    def iter_load_container(self, event, value, parse_gen, pause=None):
+        # Return a generator that does the work of load_container(), and
+        # returns its result, but yields (None) after any event for which
+        # calling pause, if specified, returns True, thus allowing the load to
+        # be suspended and resumed.
+
         # Create an initial, root object to represent the initial container.
         if (event == Events.OBJECT_OPEN or event == Events.OBJECT_KEY):
             root = {}
@@ -703,19 +2061,1622 @@ class Parser:
                 # current object container.
                 container[key] = self.convert(event, value)
 
+            if pause is not None and pause():
+                yield
+
         # Return the mutated root object.
         return root
 
+    def iter_load(self, pause):
+        # Return a generator that does the work of load(), as for
+        # iter_load_container().
+        parse_gen = self.parse()
+        event, value = next(parse_gen)
+        if (event == Events.STRING
+            or event == Events.NUMBER
+            or event == Events.NULL
+            or event == Events.TRUE
+            or event == Events.FALSE):
+            return self.convert(event, value)
+        return (yield from self.iter_load_container(event, value, parse_gen,
+                                                    pause))
+
+    def step_budget_exhausted(self):
+        # Return a bool indicating whether the current step()'s budget has
+        # been used up.
+        return (
+            (self.step_max_char_num is not None
+             and self.char_num >= self.step_max_char_num)
+            or (self.step_deadline is not None
+                and self.step_clock() >= self.step_deadline)
+        )
+
+    def step(self, max_bytes=None, max_seconds=None):
+        # Advance a cooperative load() of the stream by about max_bytes bytes
+        # and / or max_seconds seconds, checking the budget after each event,
+        # and return a ( <done>, <value> ) tuple, where value is the load()
+        # result once done, otherwise None. The partially-built containers
+        # and the parser state are kept between calls.
+        if self.step_error is not None:
+            # The load failed, so don't report it as done.
+            raise self.step_error
+        if self.step_done:
+            return True, self.step_result
+        if self.step_gen is None:
+            self.step_gen = self.iter_load(self.step_budget_exhausted)
+        self.step_max_char_num = (
+            None if max_bytes is None else self.char_num + max_bytes
+        )
+        if max_seconds is None:
+            self.step_deadline = None
+        else:
+            if self.step_clock is None:
+                try:
+                    from time import monotonic
+                except ImportError:
+                    # Use the MicroPython millisecond counter.
+                    from time import ticks_ms
+                    monotonic = lambda: ticks_ms() / 1000
+                self.step_clock = monotonic
+            self.step_deadline = self.step_clock() + max_seconds
+        try:
+            next(self.step_gen)
+        except StopIteration as e:
+            self.step_gen = None
+            self.step_done = True
+            self.step_result = e.value
+            return True, e.value
+        except Exception as e:
+            # The generator can't be resumed, so raise the same exception on
+            # any subsequent call.
+            self.step_gen = None
+            self.step_error = e
+            raise
+        return False, None
+
+###############################################################################
+# ParserPool
+#
+# A ParserPool hands out ready-to-use, reset() Parsers, along with their
+# stacks and any preallocated read buffers, so that parsing many small
+# documents doesn't allocate new ones for each, which matters most on
+# memory-constrained devices where repeated allocation fragments the heap.
+###############################################################################
+
+class ParserPool:
+    def __init__(self, size=8, encoding='utf-8', buffer_size=0,
+                 new_buffer=None):
+        # size is the maximum number of idle Parsers to keep in the pool.
+        # new_buffer, if specified, is a function that returns a preallocated
+        # bytearray, e.g. lambda: bytearray(4096), to pass as the buffer
+        # argument of each new Parser, which keeps and reuses it for every
+        # stream that it's reset() to parse.
+        self.size = size
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.new_buffer = new_buffer
+        # Use a lock, if threads are available, to make acquire() and release()
+        # thread-safe.
+        self.lock = allocate_lock() if allocate_lock is not None else None
+        self.parsers = [self.new_parser(None) for _ in range(size)]
+
+    def new_parser(self, stream):
+        # Return a new Parser for stream with the pool's configuration.
+        return Parser(
+            stream, self.encoding, self.buffer_size,
+            buffer=self.new_buffer() if self.new_buffer is not None else None
+        )
+
+    def acquire(self, stream):
+        # Return an idle Parser that has been reset() to parse stream, or a new
+        # Parser if none are idle.
+        parser = None
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            if self.parsers:
+                parser = self.parsers.pop()
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        if parser is None:
+            return self.new_parser(stream)
+        parser.reset(stream)
+        return parser
+
+    def release(self, parser):
+        # Return an acquire()d Parser to the pool, dropping its reference to
+        # the stream. If the pool is full, the Parser is discarded.
+        parser.reset(None)
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            if len(self.parsers) < self.size:
+                self.parsers.append(parser)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def load(self, stream):
+        # Return the result of calling load() on a pooled Parser.
+        parser = self.acquire(stream)
+        try:
+            return parser.load()
+        finally:
+            self.release(parser)
+
+###############################################################################
+# ResultCache
+#
+# A ResultCache stores load() and yield_paths() results, keyed by the identity
+# of their source, in order to avoid re-parsing unchanged sources. The total
+# estimated size of the results is bounded, with the least recently used
+# results being evicted first.
+###############################################################################
+
+def estimate_size(value):
+    # Return a rough estimate of the number of bytes of memory used by a
+    # load()ed value.
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            size += 64 + 48 * len(value)
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            size += 56 + 8 * len(value)
+            stack.extend(value)
+        elif isinstance(value, (str, bytes)):
+            size += 48 + len(value)
+        else:
+            size += 24
+    return size
+
+class ResultCache:
+    def __init__(self, max_bytes=16777216, pool=None):
+        # max_bytes is the maximum total estimate_size() of the cached results,
+        # and pool is the ParserPool from which to acquire Parsers.
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.pool = pool if pool is not None else ParserPool()
+        # Map keys to ( <result>, <size> ) tuples, in least to most recently
+        # used order.
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Use a lock, if threads are available, to make the cache thread-safe.
+        self.lock = allocate_lock() if allocate_lock is not None else None
+
+    def get_source_key(self, source):
+        # Return a key that identifies the content of source, which is either
+        # a file path, for which the key includes its size and modification
+        # time, or bytes, for which the key is a hash of the content.
+        if isinstance(source, str):
+            from os import stat
+            st = stat(source)
+            return ('file', source, st[6], getattr(st, 'st_mtime_ns', st[8]))
+        if isinstance(source, (bytes, bytearray)):
+            from hashlib import sha256
+            return ('sha256', sha256(source).digest())
+        raise ValueError('Please specify a key for stream sources')
+
+    def get(self, key):
+        # Return the cached result for key, or MISSING_VALUE if it's not
+        # cached, updating the hit / miss counts.
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING_VALUE
+            # Re-insert the entry as the most recently used.
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def put(self, key, result):
+        # Cache the result for key, evicting the least recently used results
+        # as necessary. Results larger than max_bytes are not cached.
+        size = estimate_size(result)
+        if size > self.max_bytes:
+            return
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.num_bytes -= entry[1]
+            while self.num_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+            self.entries[key] = (result, size)
+            self.num_bytes += size
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def clear(self):
+        # Remove all of the cached results.
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.num_bytes = 0
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def open(self, source):
+        # Return a binary stream for a file path, bytes, or stream source.
+        if isinstance(source, str):
+            return open(source, 'rb')
+        if isinstance(source, (bytes, bytearray)):
+            from io import BytesIO
+            return BytesIO(source)
+        return source
+
+    def call(self, key, source, fn):
+        # Return the cached result for key, or the result of calling fn with a
+        # pooled Parser for source.
+        result = self.get(key)
+        if result is not MISSING_VALUE:
+            return result
+        stream = self.open(source)
+        parser = self.pool.acquire(stream)
+        try:
+            result = fn(parser)
+        finally:
+            self.pool.release(parser)
+            if stream is not source:
+                stream.close()
+        self.put(key, result)
+        return result
+
+    def load(self, source, key=None):
+        # Return the load() result for source, which is a file path, bytes, or
+        # a stream in which case a key that identifies its content, e.g. an
+        # HTTP ETag, must be specified. Cached results are shared, so must not
+        # be modified.
+        if key is None:
+            key = self.get_source_key(source)
+        return self.call(('load', key), source, Parser.load)
+
+    def yield_paths(self, source, paths, key=None):
+        # Yield the yield_paths() results for source, as for load(), caching
+        # them by the requested paths, in any order, since the results are in
+        # document order regardless.
+        if key is None:
+            key = self.get_source_key(source)
+        paths_key = frozenset(tuple(path) for path in paths)
+        yield from self.call(
+            ('yield_paths', key, paths_key),
+            source,
+            lambda parser: list(parser.yield_paths(paths))
+        )
+
+###############################################################################
+# Dispatcher
+#
+# A Dispatcher invokes handler functions that are registered against path
+# patterns for values, container entries, and container exits, driving the
+# Parser directly with next_event() rather than via the parse() generator.
+###############################################################################
+
+class DispatchNode:
+    # A node in the Dispatcher tree of path pattern segments.
+    __slots__ = (
+        'children',
+        'wildcard',
+        'value_handlers',
+        'enter_handlers',
+        'exit_handlers',
+    )
+
+    def __init__(self):
+        # Map literal object keys / array indexes to child nodes.
+        self.children = {}
+        # Store the child node for a WILDCARD segment.
+        self.wildcard = None
+        self.value_handlers = []
+        self.enter_handlers = []
+        self.exit_handlers = []
+
+def encode_dispatch_node(node, encoding):
+    # Return a copy of the DispatchNode tree with the object keys encoded as
+    # bytes, as for encode_path(), and the same handler lists.
+    copy = DispatchNode()
+    for segment, child in node.children.items():
+        segment = encode_path((segment,), encoding)[0]
+        copy.children[segment] = encode_dispatch_node(child, encoding)
+    if node.wildcard is not None:
+        copy.wildcard = encode_dispatch_node(node.wildcard, encoding)
+    copy.value_handlers = node.value_handlers
+    copy.enter_handlers = node.enter_handlers
+    copy.exit_handlers = node.exit_handlers
+    return copy
+
+def get_child_dispatch_nodes(nodes, segment):
+    # Return the list of child nodes of nodes that match the path segment.
+    child_nodes = []
+    for node in nodes:
+        child = node.children.get(segment)
+        if child is not None:
+            child_nodes.append(child)
+        if node.wildcard is not None:
+            child_nodes.append(node.wildcard)
+    return child_nodes
+
+class Dispatcher:
+    def __init__(self):
+        self.root = DispatchNode()
+
+    def get_node(self, pattern):
+        # Return the node for the specified dot-delimited path pattern string
+        # (with an empty string specifying the root) or path pattern list,
+        # creating it if necessary.
+        if isinstance(pattern, str):
+            pattern = pattern and convert_dot_path_to_yield_path(pattern)
+        node = self.root
+        for segment in pattern:
+            if segment == WILDCARD:
+                if node.wildcard is None:
+                    node.wildcard = DispatchNode()
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(segment, DispatchNode())
+        return node
+
+    def on_value(self, pattern, fn):
+        # Register fn to be called as fn(<path>, <value>) with the Python
+        # value of each scalar or container at a path that matches pattern.
+        self.get_node(pattern).value_handlers.append(fn)
+        return self
+
+    def on_enter(self, pattern, fn):
+        # Register fn to be called as fn(<path>) when an array or object opens
+        # at a path that matches pattern.
+        self.get_node(pattern).enter_handlers.append(fn)
+        return self
+
+    def on_exit(self, pattern, fn):
+        # Register fn to be called as fn(<path>) when an array or object closes
+        # at a path that matches pattern.
+        self.get_node(pattern).exit_handlers.append(fn)
+        return self
+
+    def run(self, parser):
+        # Parse the document in a single pass, invoking the registered
+        # handlers. Handlers receive the current path list, which is mutated as
+        # parsing proceeds, so copy it if you need to keep it around.
+        # Containers for which there are no handlers at or below their path
+        # are skipped. Containers that have value handlers and handlers below
+        # their path are built as parsing proceeds, as for yield_paths(), so
+        # that the handlers within them are also invoked. If the parser's
+        # encoding is None, the pattern keys are encoded for comparison with
+        # the raw keys.
+        root = self.root
+        if parser.encoding is None:
+            root = encode_dispatch_node(root, 'utf-8')
+        path = []
+        # Define a stack of the lists of nodes that match the paths of the
+        # currently-open containers.
+        nodes_stack = []
+        # Store the list of nodes that match the path of the next value.
+        nodes = [root]
+        # Define a stack of ( <container>, <path-length> ) tuples for the
+        # containers that are currently being built, i.e. containers with
+        # value handlers and handlers below their path, and all of the
+        # containers within them.
+        build_stack = []
+
+        def attach(value):
+            # Attach a value to the innermost container being built.
+            container = build_stack[-1][0]
+            if type(container) is list:
+                container.append(value)
+            else:
+                container[path[-1]] = value
+
+        while parser.expect_stack:
+            event, value_gen, expect = parser.next_event()
+            if event is Events.EOF:
+                return
+            # Push whatever's expected next, as parse() would.
+            if expect is not None:
+                parser.expect_stack.append(expect)
+
+            if event == Events.OBJECT_KEY:
+                path[-1] = parser.convert(event, value_gen)
+                nodes = get_child_dispatch_nodes(nodes_stack[-1], path[-1])
+                continue
+
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                path.pop()
+                closed_nodes = nodes_stack.pop()
+                if build_stack and build_stack[-1][1] == len(path):
+                    value = build_stack.pop()[0]
+                    for node in closed_nodes:
+                        for fn in node.value_handlers:
+                            fn(path, value)
+                for node in closed_nodes:
+                    for fn in node.exit_handlers:
+                        fn(path)
+                continue
+
+            if (event == Events.KV_SEP
+                or event == Events.ARRAY_ITEM_SEP
+                or event == Events.OBJECT_ITEM_SEP):
+                continue
+
+            # The event is either a container open or a value.
+            if path and isinstance(path[-1], int):
+                # We're in an array, so increment the index.
+                path[-1] += 1
+                nodes = get_child_dispatch_nodes(nodes_stack[-1], path[-1])
+
+            build = build_stack or any(node.value_handlers for node in nodes)
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                for node in nodes:
+                    for fn in node.enter_handlers:
+                        fn(path)
+                if any(node.children or node.wildcard for node in nodes):
+                    if build:
+                        # Build the container while dispatching the values
+                        # within it.
+                        value = {} if event == Events.OBJECT_OPEN else []
+                        if build_stack:
+                            attach(value)
+                        build_stack.append((value, len(path)))
+                    # Open the container.
+                    nodes_stack.append(nodes)
+                    path.append(PERIOD if event == Events.OBJECT_OPEN else -1)
+                    continue
+                if build:
+                    # Load the container and pass it to the value handlers.
+                    value = parser.load_container(event, None, parser.parse())
+                    if build_stack:
+                        attach(value)
+                else:
+                    # Nothing within the container is of interest.
+                    parser.skip_container()
+                    value = None
+                for node in nodes:
+                    for fn in node.value_handlers:
+                        fn(path, value)
+                for node in nodes:
+                    for fn in node.exit_handlers:
+                        fn(path)
+                continue
+
+            # The event is a scalar value.
+            if build:
+                value = parser.convert(event, value_gen)
+                if build_stack:
+                    attach(value)
+                for node in nodes:
+                    for fn in node.value_handlers:
+                        fn(path, value)
+            elif value_gen is not None:
+                for _ in value_gen:
+                    pass
+
+###############################################################################
+# RecordSchema
+#
+# A RecordSchema describes the fields to extract from each object in an array
+# of homogeneous records. It's compiled into a tree of raw key bytes which is
+# used to extract the field values without decoding non-schema keys or
+# building intermediate dicts.
+###############################################################################
+
+# Map the value events to the Python type of the value that they represent.
+EVENT_VALUE_TYPES = {}
+for _prefix in ('', 'ARRAY_VALUE_', 'OBJECT_VALUE_'):
+    EVENT_VALUE_TYPES[_prefix + 'STRING'] = str
+    EVENT_VALUE_TYPES[_prefix + 'NUMBER'] = float
+    EVENT_VALUE_TYPES[_prefix + 'TRUE'] = bool
+    EVENT_VALUE_TYPES[_prefix + 'FALSE'] = bool
+    EVENT_VALUE_TYPES[_prefix + 'NULL'] = None
+del _prefix
+
+# Define the array.array typecodes, NumPy dtypes, and missing / null value
+# placeholders for the extract_columns() columns of each field type.
+COLUMN_TYPECODES = {int: 'q', float: 'd', bool: 'b'}
+NUMPY_DTYPES = {int: 'int64', float: 'float64', bool: 'bool'}
+COLUMN_DEFAULTS = {int: 0, float: 0.0, bool: False, str: None}
+
+def make_record_class(name, attrs):
+    # Return a new class with the specified __slots__ attribute names.
+    def __repr__(self):
+        return '{}({})'.format(name, ', '.join(
+            '{}={!r}'.format(attr, getattr(self, attr)) for attr in attrs
+        ))
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, attr) == getattr(other, attr) for attr in attrs
+        )
+    return type(name, (object,), {
+        '__slots__': tuple(attrs),
+        '__repr__': __repr__,
+        '__eq__': __eq__,
+    })
+
+class RecordSchema:
+    def __init__(self, fields, cls=None, encoding='utf-8'):
+        # fields is an iterable of ( <path>, <type> ) or
+        # ( <path>, <type>, <attr> ) tuples where:
+        #   path is an object key, a dot-delimited path string as accepted by
+        #     the CLI but with digit segments being object keys, or a list of
+        #     object keys, relative to the record
+        #   type is one of: str, int, float, bool
+        #   attr is the record attribute name, defaulting to the
+        #     underscore-joined path
+        # cls is the class to instantiate for each record, which may be either
+        # a namedtuple or a __slots__ class with the field attributes. If not
+        # specified, a __slots__ class is created.
+        self.encoding = encoding
+        self.types = []
+        self.attrs = []
+        self.paths = []
+        # Compile the field paths into a tree of dicts keyed by the raw
+        # (encoded) object key bytes, the leaves of which are field indexes.
+        self.tree = {}
+        for field in fields:
+            path, _type = field[:2]
+            if isinstance(path, str):
+                # Records are objects, so digit segments are object keys.
+                path = convert_dot_path_to_yield_path(path, keys_only=True)
+            path = list(path)
+            if not all(isinstance(key, str) for key in path):
+                raise ValueError('Schema paths must be object keys', path)
+            if _type not in (str, int, float, bool):
+                raise TypeError('Unsupported schema field type', _type)
+            attr = field[2] if len(field) > 2 else '_'.join(path)
+            if not attr.isidentifier():
+                # e.g. the default attr of a numeric key.
+                raise ValueError('Invalid schema field attr', attr)
+            node = self.tree
+            for key in path[:-1]:
+                node = node.setdefault(key.encode(encoding), {})
+                if not isinstance(node, dict):
+                    raise ValueError('Overlapping schema path', path)
+            key = path[-1].encode(encoding)
+            if key in node:
+                raise ValueError('Overlapping schema path', path)
+            node[key] = len(self.types)
+            self.types.append(_type)
+            self.attrs.append(attr)
+            self.paths.append(path)
+        self.cls = cls or make_record_class('Record', self.attrs)
+
+    def iter_values(self, parser, path=()):
+        # Yield a list of field values, in schema order, for each of the
+        # objects in the array at the specified path, with missing and null
+        # fields set to None. Note that the same list is reused for every
+        # record, so copy it if you need to keep it around.
+        path = list(path)
+        parse_gen = parser.parse()
+        # Advance the parser to the array.
+        for event, _, _path in parser.yield_path_events(parse_gen):
+            if event == Events.ARRAY_OPEN and _path == path:
+                break
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                # Skip containers that can't contain the array.
+                if (len(_path) >= len(path)
+                    or not match_path_prefix(_path, path)):
+                    parser.skip_container()
+        else:
+            return
+
+        num_fields = len(self.types)
+        values = [None] * num_fields
+        tree = self.tree
+        types = self.types
+        # Define a stack of the currently-open schema tree nodes, the last of
+        # which is the node for the object that we're currently parsing.
+        node_stack = []
+        node = None
+        # Define a place to store the last-parsed raw object key and its tree
+        # node or field index, or None if it's not in the schema.
+        key = None
+        child = None
+
+        def mismatch(expected, event):
+            # Return a SchemaMismatch for the value of the last-parsed key.
+            return SchemaMismatch(key.decode(self.encoding), expected, event)
+
+        for event, value in parse_gen:
+            if event == Events.OBJECT_KEY:
+                key = b''.join(value)
+                child = node.get(key)
+            elif event == Events.OBJECT_OPEN:
+                if node is None:
+                    # A record has opened.
+                    for i in range(num_fields):
+                        values[i] = None
+                    node = tree
+                elif child is None:
+                    parser.skip_container()
+                elif type(child) is int:
+                    raise mismatch(types[child], event)
+                else:
+                    node_stack.append(node)
+                    node = child
+            elif event == Events.OBJECT_CLOSE:
+                if node_stack:
+                    node = node_stack.pop()
+                else:
+                    # The record has closed.
+                    node = None
+                    yield values
+            elif event == Events.ARRAY_OPEN:
+                if node is None:
+                    raise SchemaMismatch(path, 'OBJECT_OPEN', event)
+                if child is not None:
+                    raise mismatch(
+                        types[child] if type(child) is int else dict, event
+                    )
+                parser.skip_container()
+            elif event == Events.ARRAY_CLOSE:
+                # The record array has closed.
+                return
+            elif event.startswith('OBJECT_VALUE_'):
+                if child is None:
+                    continue
+                value_type = EVENT_VALUE_TYPES[event]
+                if value_type is None:
+                    # The value is null.
+                    continue
+                if type(child) is not int:
+                    raise mismatch(dict, event)
+                _type = types[child]
+                if _type is str:
+                    if value_type is not str:
+                        raise mismatch(_type, event)
+                    value = b''.join(value).decode(self.encoding)
+                elif _type is bool:
+                    if value_type is not bool:
+                        raise mismatch(_type, event)
+                    value = event == Events.OBJECT_VALUE_TRUE
+                else:
+                    if value_type is not float:
+                        raise mismatch(_type, event)
+                    value = b''.join(value)
+                    if _type is int and PERIOD in value:
+                        raise mismatch(_type, event)
+                    value = _type(value)
+                values[child] = value
+            elif event.startswith('ARRAY_VALUE_'):
+                # A scalar record.
+                raise SchemaMismatch(path, 'OBJECT_OPEN', event)
+
+    def extract_columns(self, parser, path=(), as_numpy=False):
+        # Extract the fields of the objects in the array at the specified path
+        # into columns and return a ( <columns>, <null-masks> ) tuple of dicts
+        # keyed by field attribute name, where:
+        #   columns are array.array buffers, or lists for str fields, with
+        #     missing and null values stored as 0 / None
+        #   null-masks are bytearrays with a 1 for each missing or null value
+        # If as_numpy is True, the columns and masks are returned as NumPy
+        # arrays that share the memory of the array.array buffers.
+        from array import array
+        columns = []
+        null_masks = []
+        defaults = []
+        for _type in self.types:
+            if _type is str:
+                columns.append([])
+            else:
+                columns.append(array(COLUMN_TYPECODES[_type]))
+            null_masks.append(bytearray())
+            defaults.append(COLUMN_DEFAULTS[_type])
+        # Get references to the append methods to avoid per-value lookups.
+        column_appends = [column.append for column in columns]
+        null_mask_appends = [null_mask.append for null_mask in null_masks]
+        field_idxs = range(len(columns))
+        for values in self.iter_values(parser, path):
+            for i in field_idxs:
+                value = values[i]
+                if value is None:
+                    column_appends[i](defaults[i])
+                    null_mask_appends[i](1)
+                else:
+                    column_appends[i](value)
+                    null_mask_appends[i](0)
+        if as_numpy:
+            import numpy
+            columns = [
+                numpy.array(column, dtype=object) if _type is str
+                else numpy.frombuffer(column, dtype=NUMPY_DTYPES[_type])
+                for _type, column in zip(self.types, columns)
+            ]
+            null_masks = [
+                numpy.frombuffer(null_mask, dtype=bool)
+                for null_mask in null_masks
+            ]
+        return (
+            dict(zip(self.attrs, columns)),
+            dict(zip(self.attrs, null_masks))
+        )
+
+    def extract(self, parser, path=()):
+        # Yield a cls instance for each of the objects in the array at the
+        # specified path.
+        cls = self.cls
+        if issubclass(cls, tuple):
+            for values in self.iter_values(parser, path):
+                yield cls(*values)
+            return
+        attrs = self.attrs
+        for values in self.iter_values(parser, path):
+            record = cls.__new__(cls)
+            for attr, value in zip(attrs, values):
+                setattr(record, attr, value)
+            yield record
+
+###############################################################################
+# Profiler
+#
+# A Profiler collects per-path statistics about a document in a single pass,
+# with array indexes collapsed into WILDCARD segments. Memory is bounded by
+# tracking at most max_paths paths, each of which keeps a fixed-size reservoir
+# sample of its scalar values and a fixed number of Misra-Gries counters of its
+# most frequent string values.
+###############################################################################
+
+# Map the Python value types to the profiled type names.
+PROFILE_TYPE_NAMES = {
+    str: 'string',
+    int: 'integer',
+    float: 'number',
+    bool: 'boolean',
+    None: 'null',
+}
+
+class PathProfile:
+    # The statistics for a single profiled path.
+    __slots__ = (
+        'count',
+        'types',
+        'min',
+        'max',
+        'num_strings',
+        'min_bytes',
+        'max_bytes',
+        'total_bytes',
+        'num_containers',
+        'min_items',
+        'max_items',
+        'total_items',
+        'num_scalars',
+        'samples',
+        'frequent',
+    )
+
+    def __init__(self):
+        self.count = 0
+        # Map type names to counts.
+        self.types = {}
+        # The number value range.
+        self.min = None
+        self.max = None
+        # The string value byte lengths.
+        self.num_strings = 0
+        self.min_bytes = None
+        self.max_bytes = None
+        self.total_bytes = 0
+        # The array / object item counts.
+        self.num_containers = 0
+        self.min_items = None
+        self.max_items = None
+        self.total_items = 0
+        # The reservoir sample of scalar values.
+        self.num_scalars = 0
+        self.samples = []
+        # Map raw string value bytes to approximate counts.
+        self.frequent = {}
+
+class Profiler:
+    def __init__(self, max_paths=1024, sample_size=5, max_frequent=8,
+                 encoding='utf-8'):
+        from random import randrange
+        self.randrange = randrange
+        self.max_paths = max_paths
+        self.sample_size = sample_size
+        self.max_frequent = max_frequent
+        self.encoding = encoding
+        # Map tuples of raw object keys and WILDCARDs to PathProfiles.
+        self.profiles = {}
+        # Count the values at paths that weren't tracked due to max_paths.
+        self.untracked_count = 0
+
+    def get_profile(self, key):
+        # Return the PathProfile for the path key tuple, creating it if
+        # possible, otherwise None.
+        profile = self.profiles.get(key)
+        if profile is None:
+            if len(self.profiles) >= self.max_paths:
+                self.untracked_count += 1
+                return None
+            profile = self.profiles[key] = PathProfile()
+        profile.count += 1
+        return profile
+
+    def add_sample(self, profile, value):
+        # Add a scalar value to the profile's reservoir sample.
+        profile.num_scalars += 1
+        if len(profile.samples) < self.sample_size:
+            profile.samples.append(value)
+        else:
+            i = self.randrange(profile.num_scalars)
+            if i < self.sample_size:
+                profile.samples[i] = value
+
+    def add_frequent(self, profile, s):
+        # Count a raw string value using the Misra-Gries frequent items
+        # algorithm, which guarantees to track any value that occurs in more
+        # than 1 / (max_frequent + 1) of the path's string values.
+        frequent = profile.frequent
+        if s in frequent:
+            frequent[s] += 1
+        elif len(frequent) < self.max_frequent:
+            frequent[s] = 1
+        else:
+            # Decrement all of the counters, dropping those that reach zero.
+            for k in list(frequent):
+                if frequent[k] == 1:
+                    del frequent[k]
+                else:
+                    frequent[k] -= 1
+
+    def run(self, parser):
+        # Profile the document in a single pass and return self.
+        types = PROFILE_TYPE_NAMES
+        # Define a stack of [ <profile>, <path-key>, <num-items> ] lists for
+        # the currently-open containers.
+        stack = []
+        for event, value, path in parser.yield_path_events(raw_keys=True):
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                profile, _, n = stack.pop()
+                if profile is not None:
+                    profile.num_containers += 1
+                    profile.total_items += n
+                    if profile.min_items is None or n < profile.min_items:
+                        profile.min_items = n
+                    if profile.max_items is None or n > profile.max_items:
+                        profile.max_items = n
+                continue
+
+            # Get the key of the collapsed path.
+            if stack:
+                parent = stack[-1]
+                parent[2] += 1
+                seg = path[-1]
+                key = parent[1] + (WILDCARD if isinstance(seg, int) else seg,)
+            else:
+                key = ()
+            profile = self.get_profile(key)
+
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                if profile is not None:
+                    type_name = (
+                        'object' if event == Events.OBJECT_OPEN else 'array'
+                    )
+                    profile.types[type_name] = \
+                        profile.types.get(type_name, 0) + 1
+                stack.append([profile, key, 0])
+                continue
+
+            if profile is None:
+                if value is not None:
+                    for _ in value:
+                        pass
+                continue
+
+            _type = EVENT_VALUE_TYPES[event]
+            if _type is str:
+                s = b''.join(value)
+                n = len(s)
+                profile.num_strings += 1
+                profile.total_bytes += n
+                if profile.min_bytes is None or n < profile.min_bytes:
+                    profile.min_bytes = n
+                if profile.max_bytes is None or n > profile.max_bytes:
+                    profile.max_bytes = n
+                self.add_frequent(profile, s)
+                value = s
+            elif _type is float:
+                value = parser.convert(event, value)
+                _type = type(value)
+                if profile.min is None or value < profile.min:
+                    profile.min = value
+                if profile.max is None or value > profile.max:
+                    profile.max = value
+            elif _type is bool:
+                value = (
+                    event == Events.TRUE
+                    or event == Events.ARRAY_VALUE_TRUE
+                    or event == Events.OBJECT_VALUE_TRUE
+                )
+            type_name = types[_type]
+            profile.types[type_name] = profile.types.get(type_name, 0) + 1
+            self.add_sample(profile, value)
+        return self
+
+    def decode(self, s):
+        return s if self.encoding is None else s.decode(self.encoding)
+
+    def report(self):
+        # Return a JSON-serializable dict of the form:
+        #   { 'paths': { <dot-path>: <stats>, ... }, 'untracked': <count> }
+        # where the object keys in each dot-path are decoded and array indexes
+        # are *, and stats includes, where applicable, the number value range,
+        # the string value byte lengths, the container item counts, a sample
+        # of scalar values, and the approximate counts of frequent string
+        # values.
+        paths = {}
+        for key, profile in sorted(
+                self.profiles.items(),
+                key=lambda x: [str(seg) for seg in x[0]]):
+            stats = {'count': profile.count, 'types': profile.types}
+            if profile.min is not None:
+                stats['min'] = profile.min
+                stats['max'] = profile.max
+            if profile.num_strings:
+                stats['min_bytes'] = profile.min_bytes
+                stats['max_bytes'] = profile.max_bytes
+                stats['mean_bytes'] = \
+                    profile.total_bytes / profile.num_strings
+            if profile.num_containers:
+                stats['min_items'] = profile.min_items
+                stats['max_items'] = profile.max_items
+                stats['mean_items'] = \
+                    profile.total_items / profile.num_containers
+            if profile.samples:
+                stats['samples'] = [
+                    self.decode(v) if isinstance(v, bytes) else v
+                    for v in profile.samples
+                ]
+            if profile.frequent:
+                stats['frequent'] = [
+                    [self.decode(s), n] for s, n in sorted(
+                        profile.frequent.items(), key=lambda x: -x[1]
+                    )
+                ]
+            dot_path = convert_yielded_key_to_dot_path(
+                seg if seg is WILDCARD else self.decode(seg) for seg in key
+            )
+            paths[dot_path] = stats
+        return {'paths': paths, 'untracked': self.untracked_count}
+
+###############################################################################
+# ChangeDetector
+#
+# A ChangeDetector computes a fingerprint tree of per-subtree hashes of a
+# document as it's parsed, compares it against the fingerprint tree of a
+# previous version of the document, and yields the paths that were added,
+# removed, or changed, without building the document's values.
+#
+# Fingerprint tree nodes are either the hex digest of a scalar value (or of a
+# container below max_depth), or a [ <hex-digest>, <children> ] list for a
+# container, where children is a dict of object keys to nodes or a list of
+# array item nodes, such that the tree can be stored as JSON.
+###############################################################################
+
+def get_node_digest(node):
+    # Return the hex digest of a fingerprint tree node.
+    return node if isinstance(node, str) else node[0]
+
+class ChangeDetector:
+    def __init__(self, max_depth=None, digest_size=8):
+        # max_depth is the container depth below which the children of
+        # containers are not stored in the fingerprint tree, and changes
+        # within them are reported as changes to the container.
+        self.max_depth = max_depth
+        self.digest_size = digest_size
+        # Store the fingerprint tree of the last document passed to diff().
+        self.fingerprint = None
+
+    def hash(self, data):
+        from hashlib import blake2b
+        return blake2b(data, digest_size=self.digest_size).digest()
+
+    def diff(self, parser, fingerprint=None):
+        # Yield ( <change>, <path> ) tuples, where change is one of 'added',
+        # 'removed', or 'changed', for the differences between the document
+        # and the one described by fingerprint, and set self.fingerprint to
+        # the document's fingerprint tree. If fingerprint is None, the whole
+        # document is reported as added.
+        #
+        # Object item hashes are summed so that object key order doesn't
+        # matter, while array item hashes are hashed in order.
+        from hashlib import blake2b
+        hash = self.hash
+        modulus = 1 << (8 * self.digest_size)
+        convert_key = lambda seg: (
+            parser.convert(Events.OBJECT_KEY, (seg,))
+            if isinstance(seg, bytes) else seg
+        )
+        self.fingerprint = None
+        # Define a stack of [ <is-object>, <children>, <old-node>,
+        # <old-children>, <reportable>, <hash-accumulator> ] lists for the
+        # currently-open containers, where children is None below max_depth,
+        # old-children is None unless the container's children are being
+        # compared individually, and reportable indicates whether changes to
+        # the container are to be reported.
+        stack = []
+        for event, value, path in parser.yield_path_events(raw_keys=True):
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                (is_object, children, old, old_children, reportable,
+                 acc) = stack.pop()
+                if is_object:
+                    digest = hash(b'{' + acc.to_bytes(self.digest_size, 'big'))
+                else:
+                    digest = hash(b'[' + acc.digest())
+                hex_digest = digest.hex()
+                node = hex_digest
+                if children is not None:
+                    node = [hex_digest, children]
+                if old_children is not None:
+                    # The children have been compared so report only those
+                    # that no longer exist.
+                    if is_object:
+                        for key in old_children:
+                            if key not in children:
+                                yield 'removed', \
+                                    list(map(convert_key, path)) + [key]
+                    else:
+                        for i in range(len(children), len(old_children)):
+                            yield 'removed', \
+                                list(map(convert_key, path)) + [i]
+                elif reportable:
+                    if old is None:
+                        yield 'added', list(map(convert_key, path))
+                    elif get_node_digest(old) != hex_digest:
+                        yield 'changed', list(map(convert_key, path))
+            else:
+                # Get the previous version's node for this value and whether
+                # changes to it are to be reported.
+                if not stack:
+                    old = fingerprint
+                    reportable = True
+                else:
+                    parent = stack[-1]
+                    old_children = parent[3]
+                    reportable = old_children is not None
+                    old = None
+                    if reportable:
+                        seg = path[-1]
+                        if parent[0]:
+                            old = old_children.get(convert_key(seg))
+                        elif seg < len(old_children):
+                            old = old_children[seg]
+
+                if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                    is_object = event == Events.OBJECT_OPEN
+                    children = None
+                    old_children = None
+                    if self.max_depth is None or len(stack) < self.max_depth:
+                        children = {} if is_object else []
+                        if (reportable and isinstance(old, list)
+                            and isinstance(old[1], type(children))):
+                            # Compare the children individually.
+                            old_children = old[1]
+                    stack.append([
+                        is_object, children, old, old_children, reportable,
+                        0 if is_object else blake2b(
+                            digest_size=self.digest_size
+                        ),
+                    ])
+                    continue
+
+                # The event is a scalar value. Hash its raw bytes, prefixed
+                # with a string or number indicator.
+                _type = EVENT_VALUE_TYPES[event]
+                if _type is str:
+                    digest = hash(b'"' + b''.join(value))
+                elif _type is float:
+                    digest = hash(b'0' + b''.join(value))
+                else:
+                    digest = hash(LITERAL_EVENT_BYTES[event])
+                node = digest.hex()
+                if reportable:
+                    if old is None:
+                        yield 'added', list(map(convert_key, path))
+                    elif get_node_digest(old) != node:
+                        yield 'changed', list(map(convert_key, path))
+
+            # Add the completed value's node to its parent.
+            if not stack:
+                self.fingerprint = node
+                continue
+            parent = stack[-1]
+            if parent[0]:
+                key = path[-1]
+                parent[5] = (parent[5] + int.from_bytes(
+                    hash(key + b':' + digest), 'big'
+                )) % modulus
+                if parent[1] is not None:
+                    parent[1][convert_key(key)] = node
+            else:
+                parent[5].update(digest)
+                if parent[1] is not None:
+                    parent[1].append(node)
+
+###############################################################################
+# Aggregator
+#
+# An Aggregator computes aggregate functions of the values at path patterns,
+# optionally grouped by the value of a field within the same object, in a
+# single pass, keeping only a running accumulator per aggregate and group.
+# Distinct values are counted approximately using a HyperLogLog, so memory
+# depends only on the number of groups.
+###############################################################################
+
+# Define the supported aggregate function names.
+AGGREGATE_FUNCS = ('count', 'sum', 'min', 'max', 'mean', 'distinct')
+
+class HyperLogLog:
+    # An approximate distinct counter with a standard error of about
+    # 1.04 / sqrt(2 ** precision).
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, data):
+        # Add a bytes value.
+        from hashlib import blake2b
+        x = int.from_bytes(blake2b(data, digest_size=8).digest(), 'big')
+        # Use the leading bits as the register index and the position of the
+        # first 1 bit in the remaining bits as the rank.
+        num_bits = 64 - self.precision
+        i = x >> num_bits
+        rank = num_bits - (x & ((1 << num_bits) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def count(self):
+        # Return the estimated number of distinct values.
+        from math import log
+        m = len(self.registers)
+        estimate = (
+            0.7213 / (1 + 1.079 / m) * m * m
+            / sum(2.0 ** -r for r in self.registers)
+        )
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Use linear counting for small cardinalities.
+            estimate = m * log(m / zeros)
+        return int(round(estimate))
+
+class Accumulator:
+    # The running state of an aggregate function.
+    __slots__ = ('func', 'count', 'total', 'value', 'hll')
+
+    def __init__(self, func, precision):
+        self.func = func
+        self.count = 0
+        # The sum of the numbers for sum / mean.
+        self.total = 0
+        # The current min / max.
+        self.value = None
+        self.hll = HyperLogLog(precision) if func == 'distinct' else None
+
+    def add(self, value, raw):
+        # Add a value, where raw is a bytes representation of the value that's
+        # used for distinct counting.
+        func = self.func
+        if func == 'count':
+            self.count += 1
+        elif func == 'distinct':
+            self.hll.add(raw)
+        elif type(value) is int or type(value) is float:
+            # The other functions only consider numbers.
+            self.count += 1
+            if func == 'sum' or func == 'mean':
+                self.total += value
+            elif (self.value is None
+                  or (func == 'min' and value < self.value)
+                  or (func == 'max' and value > self.value)):
+                self.value = value
+
+    def result(self):
+        func = self.func
+        if func == 'count':
+            return self.count
+        if func == 'distinct':
+            return self.hll.count()
+        if func == 'sum':
+            return self.total
+        if func == 'mean':
+            return self.total / self.count if self.count else None
+        return self.value
+
+class Aggregator:
+    def __init__(self, distinct_precision=10):
+        # distinct_precision is the HyperLogLog precision for distinct counts.
+        self.distinct_precision = distinct_precision
+        # Store ( <name>, <pattern>, <func>, <group-by-path-or-None> ) tuples.
+        self.aggregates = []
+
+    def add(self, name, pattern, func, group_by=None):
+        # Add an aggregate named name of the values at paths that match the
+        # pattern, which is a dot-delimited path pattern string or path
+        # pattern list as for Dispatcher, with func being one of
+        # AGGREGATE_FUNCS. The count of a pattern includes all values, while
+        # sum, min, max, and mean only consider numbers. If group_by, a path
+        # string or list relative to the object that contains each value, is
+        # specified, compute the aggregate separately for each value at that
+        # path, with values for which it's missing grouped under None.
+        if func not in AGGREGATE_FUNCS:
+            raise ValueError('func must be one of: {}'.format(
+                ', '.join(AGGREGATE_FUNCS)))
+        if isinstance(pattern, str):
+            pattern = convert_dot_path_to_yield_path(pattern)
+        if isinstance(group_by, str):
+            group_by = convert_dot_path_to_yield_path(group_by)
+        self.aggregates.append((name, pattern, func, group_by))
+        return self
+
+    def run(self, parser):
+        # Parse the document in a single pass and return a dict of aggregate
+        # names to results or, for grouped aggregates, dicts of group values
+        # to results. Containers that don't lead to an aggregated value or
+        # group-by value are skipped.
+        precision = self.distinct_precision
+        # Encode the patterns for comparison with the raw path keys.
+        aggregates = []
+        results = {}
+        for name, pattern, func, group_by in self.aggregates:
+            pattern = encode_path(pattern, parser.encoding)
+            if group_by is not None:
+                group_by = encode_path(group_by, parser.encoding)
+                results[name] = {}
+                accumulator = None
+            else:
+                accumulator = results[name] = Accumulator(func, precision)
+            aggregates.append((name, pattern, func, group_by, accumulator))
+        # Get the patterns of all of the paths of interest.
+        patterns = [x[1] for x in aggregates] + [
+            x[1][:-1] + x[3] for x in aggregates if x[3] is not None
+        ]
+        # Map the paths of the currently-open objects that contain grouped
+        # values to dicts of aggregate indexes to [ <group-value>,
+        # <pending-values> ] lists, where pending-values is a list of
+        # ( <value>, <raw> ) tuples for values whose group isn't known yet.
+        groups = {}
+
+        def get_group(i, parent):
+            state = groups.setdefault(tuple(parent), {})
+            if i not in state:
+                state[i] = [MISSING_VALUE, []]
+            return state[i]
+
+        def add(i, group, value, raw):
+            name, _, func, _, _ = aggregates[i]
+            accumulator = results[name].get(group)
+            if accumulator is None:
+                accumulator = results[name][group] = \
+                    Accumulator(func, precision)
+            accumulator.add(value, raw)
+
+        for event, value, path in parser.yield_path_events(raw_keys=True):
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                if groups:
+                    # Add any values whose group is missing.
+                    for i, (group, pending) in \
+                            groups.pop(tuple(path), {}).items():
+                        for value, raw in pending:
+                            add(i, None, value, raw)
+                continue
+
+            is_container = (
+                event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN
+            )
+            # Get the raw bytes of scalar values, with strings prefixed by a
+            # double-quote to distinguish them from other types, and convert
+            # them to Python values only as needed.
+            data = None
+            raw = None
+            if not is_container:
+                _type = EVENT_VALUE_TYPES[event]
+                if _type is str:
+                    data = b''.join(value)
+                    raw = b'"' + data
+                elif _type is float:
+                    data = raw = b''.join(value)
+                else:
+                    raw = LITERAL_EVENT_BYTES[event]
+            value = MISSING_VALUE
+
+            for i, (name, pattern, func, group_by, accumulator) in \
+                    enumerate(aggregates):
+                if group_by is not None and not is_container:
+                    # Check whether this is a group-by value.
+                    n = len(group_by)
+                    if (len(path) == len(pattern) - 1 + n
+                        and path[-n:] == group_by
+                        and match_path(pattern[:-1], path[:-n])):
+                        if value is MISSING_VALUE:
+                            value = parser.convert(
+                                event, None if data is None else (data,)
+                            )
+                        state = get_group(i, path[:-n])
+                        state[0] = value
+                        for pending_value in state[1]:
+                            add(i, value, *pending_value)
+                        del state[1][:]
+                if not match_path(pattern, path):
+                    continue
+                if is_container:
+                    # Containers are only counted.
+                    if func != 'count':
+                        continue
+                elif (value is MISSING_VALUE
+                      and func != 'count' and func != 'distinct'):
+                    value = parser.convert(
+                        event, None if data is None else (data,)
+                    )
+                if group_by is None:
+                    accumulator.add(value, raw)
+                    continue
+                state = get_group(i, path[:-1])
+                if state[0] is MISSING_VALUE:
+                    state[1].append((value, raw))
+                else:
+                    add(i, state[0], value, raw)
+
+            if is_container:
+                path_len = len(path)
+                if not any(len(p) > path_len
+                           and match_path_prefix(p[:path_len], path)
+                           for p in patterns):
+                    # Nothing within the container is of interest.
+                    parser.skip_container()
+
+        return {
+            name: (
+                result.result() if isinstance(result, Accumulator)
+                else {k: v.result() for k, v in result.items()}
+            )
+            for name, result in results.items()
+        }
+
+###############################################################################
+# Writer
+#
+# The Writer serializes parse() events back to JSON, copying the raw string and
+# number value bytes through as-is.
+###############################################################################
+
+class Writer:
+    def __init__(self, stream, indent=None, buffer_size=8192):
+        # stream must be a binary stream. If indent is None, the output is
+        # minified, otherwise it's pretty-printed with the specified number of
+        # spaces per indentation level.
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        if indent is None:
+            self.newline = b''
+            self.indent = b''
+            self.kv_sep = b':'
+        else:
+            self.newline = b'\n'
+            self.indent = b' ' * indent
+            self.kv_sep = b': '
+        # Define a stack to store the number of items written to each of the
+        # currently-open containers, and a parallel stack that indicates
+        # whether each container is an array.
+        self.item_counts = []
+        self.is_array_stack = []
+
+    def begin_item(self):
+        # Write the separator and indentation that precedes the next array
+        # value or object key.
+        if self.item_counts[-1]:
+            self.buffer += Matchers.ITEM_SEP
+        self.item_counts[-1] += 1
+        self.buffer += self.newline + self.indent * len(self.item_counts)
+
+    def write(self, events):
+        # Write the JSON described by an iterable of ( <event>, <value> )
+        # tuples, as yielded by Parser.parse() or Parser.project(), to the
+        # buffer, flushing it to the stream whenever it exceeds buffer_size.
+        # Separator events are ignored and separators are instead written as
+        # necessary, thus dropping any trailing commas.
+        buffer = self.buffer
+        for event, value in events:
+            if event == Events.OBJECT_CLOSE or event == Events.ARRAY_CLOSE:
+                self.is_array_stack.pop()
+                if self.item_counts.pop():
+                    buffer += (
+                        self.newline + self.indent * len(self.item_counts)
+                    )
+                buffer += (
+                    Matchers.OBJECT_CLOSE if event == Events.OBJECT_CLOSE
+                    else Matchers.ARRAY_CLOSE
+                )
+            elif event == Events.OBJECT_KEY:
+                self.begin_item()
+                buffer += b'"'
+                buffer += b''.join(value)
+                buffer += b'"'
+                buffer += self.kv_sep
+            elif (event == Events.KV_SEP
+                  or event == Events.ARRAY_ITEM_SEP
+                  or event == Events.OBJECT_ITEM_SEP):
+                continue
+            else:
+                # The event is a container open or a value. If we're in an
+                # array, begin a new item.
+                if self.is_array_stack and self.is_array_stack[-1]:
+                    self.begin_item()
+                if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                    is_array = event == Events.ARRAY_OPEN
+                    buffer += (
+                        Matchers.ARRAY_OPEN if is_array
+                        else Matchers.OBJECT_OPEN
+                    )
+                    self.is_array_stack.append(is_array)
+                    self.item_counts.append(0)
+                elif event in LITERAL_EVENT_BYTES:
+                    buffer += LITERAL_EVENT_BYTES[event]
+                elif event.endswith('STRING'):
+                    buffer += b'"'
+                    buffer += b''.join(value)
+                    buffer += b'"'
+                else:
+                    # It's a number.
+                    buffer += b''.join(value)
+            if len(buffer) >= self.buffer_size:
+                self.flush()
+
+    def write_raw(self, b):
+        # Write the bytes as-is to the buffer, flushing it to the stream if it
+        # exceeds buffer_size.
+        self.buffer += b
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Write the buffer to the stream and empty it.
+        if self.buffer:
+            self.stream.write(self.buffer)
+            del self.buffer[:]
+
+###############################################################################
+# Splitter
+#
+# A Splitter shards the items of an array into multiple JSON array or NDJSON
+# outputs by copying the raw bytes of each item, so that values are neither
+# decoded nor re-encoded and memory use is constant.
+###############################################################################
+
+class Splitter:
+    def __init__(self, open_shard, max_items=None, max_bytes=None,
+                 ndjson=False):
+        # open_shard is a function that's called with the index of each shard
+        # and returns a binary stream to write it to, which is closed once
+        # the shard is complete. A new shard is started once the current one
+        # contains max_items items or at least max_bytes bytes. If ndjson is
+        # True, each shard contains a line per item rather than an array.
+        self.open_shard = open_shard
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ndjson = ndjson
+        # The current shard's Writer and stats.
+        self.writer = None
+        self.num_shards = 0
+        self.num_items = 0
+        self.num_bytes = 0
+
+    def write(self, data):
+        # Write item bytes to the current shard.
+        if self.ndjson:
+            # Strings can't contain literal line breaks, so any that are in
+            # the data are whitespace and can be replaced.
+            data = data.replace(b'\n', b' ').replace(b'\r', b' ')
+        self.writer.write_raw(data)
+        self.num_bytes += len(data)
+
+    def begin_item(self):
+        # Start a new shard if necessary and write the separator that precedes
+        # the next item.
+        if self.writer is not None and (
+                (self.max_items is not None
+                 and self.num_items >= self.max_items)
+                or (self.max_bytes is not None
+                    and self.num_bytes >= self.max_bytes)):
+            self.end_shard()
+        if self.writer is None:
+            self.writer = Writer(self.open_shard(self.num_shards), None, 65536)
+            self.num_shards += 1
+            self.num_items = 0
+            self.num_bytes = 0
+            if not self.ndjson:
+                self.writer.write_raw(Matchers.ARRAY_OPEN)
+        elif not self.ndjson:
+            self.writer.write_raw(Matchers.ITEM_SEP)
+        self.num_items += 1
+
+    def end_item(self):
+        if self.ndjson:
+            self.writer.write_raw(b'\n')
+
+    def end_shard(self):
+        if not self.ndjson:
+            self.writer.write_raw(Matchers.ARRAY_CLOSE + b'\n')
+        self.writer.flush()
+        self.writer.stream.close()
+        self.writer = None
+
+    def run(self, parser, path=()):
+        # Shard the items of the array at path, which is a path list in the
+        # format accepted by Parser.yield_paths(), and return the number of
+        # shards written. Containers that don't lead to the array are
+        # skipped.
+        path = encode_path(path, parser.encoding)
+        path_len = len(path)
+        self.num_shards = 0
+        in_array = False
+        for event, value, _path in parser.yield_path_events(raw_keys=True):
+            if not in_array:
+                if event != Events.OBJECT_OPEN and event != Events.ARRAY_OPEN:
+                    continue
+                if _path == path:
+                    if event == Events.ARRAY_OPEN:
+                        in_array = True
+                    else:
+                        parser.skip_container()
+                elif not (len(_path) < path_len
+                          and _path == path[:len(_path)]):
+                    parser.skip_container()
+                continue
+
+            if event == Events.ARRAY_CLOSE and len(_path) == path_len:
+                # The array is complete.
+                break
+            self.begin_item()
+            if event == Events.OBJECT_OPEN or event == Events.ARRAY_OPEN:
+                self.write(
+                    Matchers.OBJECT_OPEN if event == Events.OBJECT_OPEN
+                    else Matchers.ARRAY_OPEN
+                )
+                parser.skip_container(self.write)
+            elif event in LITERAL_EVENT_BYTES:
+                self.write(LITERAL_EVENT_BYTES[event])
+            elif event == Events.ARRAY_VALUE_STRING:
+                self.write(Matchers.STRING_START + b''.join(value)
+                           + Matchers.STRING_TERMINATOR)
+            else:
+                self.write(b''.join(value))
+            self.end_item()
+        if self.writer is not None:
+            self.end_shard()
+        return self.num_shards
+
 ###############################################################################
 # CLI
 ###############################################################################
 
-def convert_dot_path_to_yield_path(path):
+def convert_dot_path_to_yield_path(path, keys_only=False):
     # Convert the dot-delimited --path argument to a path list required by
-    # Parser.yield_paths().
+    # Parser.yield_paths(). If keys_only is True, all segments are object
+    # keys, otherwise digit segments are array indexes.
     final_path = []
     i = 0
-    splits = [int(seg) if seg.isdigit() else seg for seg in path.split('.')]
+    splits = [
+        int(seg) if seg.isdigit() and not keys_only else seg
+        for seg in path.split('.')
+    ]
     splits_len = len(splits)
     while i < splits_len:
         seg = splits[i]
@@ -735,6 +3696,81 @@ def convert_dot_path_to_yield_path(path):
 def convert_yielded_key_to_dot_path(key):
     return '.'.join(str(seg) if isinstance(seg, int) else seg for seg in key)
 
+def open_cli_parser(stream, buffered, read_ahead=0):
+    # Return a Parser for a CLI input stream. Compressed or non-seekable
+    # streams, which open_decompressed() wraps, are always read in chunks and,
+    # if read_ahead is non-zero, read ahead. Other streams, e.g. files, are
+    # only read in chunks if buffered is True, which should be the case for
+    # actions that skip containers or validate, since their buffered fast
+    # paths are much faster, but not for actions that visit every character
+    # (e.g. a whole-document load), for which reading one byte at a time from
+    # an already-buffered file is faster than the Parser's own buffering.
+    stream = open_decompressed(stream)
+    if isinstance(stream, DecompressingReader):
+        return Parser(stream, buffer_size=65536, read_ahead=read_ahead)
+    return Parser(stream, buffer_size=65536 if buffered else 0)
+
+def load_cli_result(parser, paths=None, query=None):
+    # Return the result of the CLI load action, i.e. either the whole
+    # document, or a dict that maps the dot paths of the values at the
+    # specified paths, or that match the specified query, to the values.
+    if query:
+        gen = parser.query(query)
+    elif paths:
+        gen = parser.yield_paths(paths)
+    else:
+        return parser.load()
+    return {convert_yielded_key_to_dot_path(key): value for key, value in gen}
+
+def write_ndjson_results(writer, results):
+    # Write each of the ( <path>, <value> ) results yielded by
+    # Parser.yield_paths() or Parser.query() as an NDJSON line in the format:
+    #   {"path": "<dot-path>", "value": <value>}
+    from json import dumps
+    for key, value in results:
+        writer.write_raw(dumps({
+            'path': convert_yielded_key_to_dot_path(key),
+            'value': value
+        }).encode('utf-8'))
+        writer.write_raw(b'\n')
+
+def write_ndjson_events(writer, events):
+    # Write each of the events yielded by Parser.parse() as an NDJSON line in
+    # the format:
+    #   ["<event>"] or ["<event>", <value>]
+    # where string and number values are copied through as raw bytes.
+    for event, value in events:
+        if (event == Events.KV_SEP
+            or event == Events.ARRAY_ITEM_SEP
+            or event == Events.OBJECT_ITEM_SEP):
+            continue
+        writer.write_raw(b'["')
+        writer.write_raw(event.encode('utf-8'))
+        if value is None:
+            writer.write_raw(b'"]\n')
+        elif event == Events.OBJECT_KEY or event.endswith('STRING'):
+            writer.write_raw(b'","')
+            writer.write_raw(b''.join(value))
+            writer.write_raw(b'"]\n')
+        else:
+            writer.write_raw(b'",')
+            writer.write_raw(b''.join(value))
+            writer.write_raw(b']\n')
+
+def load_file_ndjson_line(job):
+    # Return an NDJSON line, as bytes, that describes the load_cli_result() of
+    # a ( <file-name>, <paths>, <query> ) job, for the CLI batch mode.
+    from json import dumps
+    file_name, paths, query = job
+    try:
+        with open(file_name, 'rb') as fh, \
+             open_cli_parser(fh, bool(paths or query)) as parser:
+            result = load_cli_result(parser, paths, query)
+        record = {'file': file_name, 'result': result}
+    except Exception as e:
+        record = {'file': file_name, 'error': repr(e)}
+    return (dumps(record) + '\n').encode('utf-8')
+
 if __name__ == '__main__':
     import argparse
     from io import BytesIO
@@ -745,56 +3781,187 @@ if __name__ == '__main__':
     g = arg_parser.add_mutually_exclusive_group()
     g.add_argument('--file', type=argparse.FileType('rb'))
     g.add_argument('--string', type=str)
-
-    arg_parser.add_argument('--action', choices=('load', 'parse'),
+    g.add_argument('--files', type=str, nargs='+',
+                   help='Load multiple files in parallel, writing an NDJSON '\
+                   'line per file to stdout')
+    g.add_argument('--glob', type=str, action='append',
+                   help='Like --files but specified as a glob pattern, with '\
+                   '** matching any number of subdirectories')
+
+    arg_parser.add_argument('--action',
+                            choices=('load', 'parse', 'minify', 'pretty',
+                                     'profile', 'validate', 'split'),
                             default="load")
     arg_parser.add_argument('--path', type=str, action='append',
                             help='Dot-delimited path specifier with dots in '\
                             'keys escaped as a double-dot')
+    arg_parser.add_argument('--query', type=str,
+                            help='JSONPath-style query, e.g. '\
+                            '$.items[?(@.type == "a")].id')
+    arg_parser.add_argument('--output', choices=('json', 'ndjson'),
+                            default='json',
+                            help='With ndjson, stream each --path / --query '\
+                            'result, or parse event, as an NDJSON line as '\
+                            'soon as it\'s parsed')
+    arg_parser.add_argument('--jobs', type=int, default=None,
+                            help='The number of --files / --glob worker '\
+                            'processes (default: the number of CPUs)')
+    arg_parser.add_argument('--ordered', action='store_true',
+                            help='Write the --files / --glob output lines in '\
+                            'input order')
+    arg_parser.add_argument('--include', type=str, action='append',
+                            help='Dot-delimited path pattern, with * '\
+                            'matching any key or index, of a subtree to '\
+                            'include in the load / minify / pretty output')
+    arg_parser.add_argument('--exclude', type=str, action='append',
+                            help='Dot-delimited path pattern of a subtree to '\
+                            'exclude from the load / minify / pretty output')
+    arg_parser.add_argument('--shard-file', type=str,
+                            default='shard-{:05d}.json',
+                            help='The split shard file name format string '\
+                            '(default: shard-{:05d}.json)')
+    arg_parser.add_argument('--shard-items', type=int,
+                            help='The maximum number of items per split shard')
+    arg_parser.add_argument('--shard-bytes', type=int,
+                            help='The number of bytes after which to start a '\
+                            'new split shard')
     args = arg_parser.parse_args()
 
     if args.string:
         args.file = BytesIO(args.string.encode('utf-8'))
 
-    if args.path and args.action != 'load':
-        arg_parser.error('Please specify --action=load when using --path')
+    if args.path and args.action not in ('load', 'split'):
+        arg_parser.error('Please specify --action=load or --action=split '\
+                         'when using --path')
 
-    parser = Parser(args.file)
+    if args.query and (args.action != 'load' or args.path):
+        arg_parser.error('Please specify --action=load and no --path when '\
+                         'using --query')
 
-    if args.action == 'load':
-        if not args.path:
-            # Load it all and pretty-print the result.
-            print(dumps(parser.load(), indent=2))
-        else:
-            # Load only the specified paths.
-            result = {}
-            # Assert that no path is the prefix of another, indicating both
-            # a container and sub sub-object which won't work because the
-            # container itself will be read/consumed before the sub-object
-            # ever has a chance.
-            num_paths = len(args.path)
-            for a in args.path:
-                for b in args.path:
-                    if a == b:
-                        continue
-                    if b.startswith(a) and b[len(a)] == '.':
-                        arg_parser.error(
-                            'Specifying container sub-elements ({}) and the '\
-                            'container itself ({}) is not supported.'
-                            .format(b, a)
-                        )
-            # Convert the dot-delimited paths to path segments lists as
-            # required by Parser.yield_paths().
-            paths = list(map(convert_dot_path_to_yield_path, args.path))
-            for key, value in parser.yield_paths(paths):
-                # Convert the yielded key back to a dot path.
-                key = convert_yielded_key_to_dot_path(key)
-                result[key] = value
-            # Print the result as JSON.
+    if ((args.include or args.exclude)
+        and (args.action not in ('load', 'minify', 'pretty')
+             or args.path or args.query or args.files or args.glob)):
+        arg_parser.error('Please specify --action=load, --action=minify, or '\
+                         '--action=pretty, and no --path, --query, --files, '\
+                         'or --glob when using --include or --exclude')
+
+    # Convert the dot-delimited paths to path segments lists as required by
+    # Parser.yield_paths().
+    paths = args.path and list(map(convert_dot_path_to_yield_path, args.path))
+
+    # Likewise convert the include / exclude path patterns.
+    include = args.include and [
+        convert_dot_path_to_yield_path(p) for p in args.include
+    ]
+    exclude = args.exclude and [
+        convert_dot_path_to_yield_path(p) for p in args.exclude
+    ]
+
+    # Compile the query to check its validity.
+    query = None
+    if args.query:
+        try:
+            query = compile_query(args.query)
+        except InvalidQuery as e:
+            arg_parser.error(str(e))
+
+    if args.files or args.glob:
+        # Load the files in a pool of worker processes and write an NDJSON
+        # line for each.
+        if args.action != 'load':
+            arg_parser.error('Please specify --action=load when using '\
+                             '--files or --glob')
+        import sys
+        from glob import glob
+        from multiprocessing import Pool
+        file_names = list(args.files or [])
+        for pattern in args.glob or ():
+            file_names.extend(sorted(glob(pattern, recursive=True)))
+        jobs = [(file_name, paths, query) for file_name in file_names]
+        out = sys.stdout.buffer
+        with Pool(args.jobs) as pool:
+            imap = pool.imap if args.ordered else pool.imap_unordered
+            for line in imap(load_file_ndjson_line, jobs, chunksize=4):
+                out.write(line)
+        out.flush()
+        sys.exit()
+
+    # Only buffer the input for the actions that benefit from it, as
+    # described by open_cli_parser().
+    buffered = bool(
+        args.action in ('validate', 'split')
+        or paths or query or include or exclude
+    )
+    with open_cli_parser(args.file, buffered, read_ahead=2) as parser:
+        if args.output == 'ndjson' and args.action in ('load', 'parse'):
+            import sys
+            writer = Writer(sys.stdout.buffer)
+            if args.action == 'parse':
+                write_ndjson_events(writer, parser.parse())
+            elif query:
+                write_ndjson_results(writer, parser.query(query))
+            elif paths:
+                write_ndjson_results(writer, parser.yield_paths(paths))
+            else:
+                write_ndjson_results(
+                    writer,
+                    [((), parser.load(include=include, exclude=exclude))]
+                )
+            writer.flush()
+
+        elif args.action == 'load' and (include or exclude):
+            # Load only the included / not excluded parts and pretty-print
+            # them.
+            result = parser.load(include=include, exclude=exclude)
             print(dumps(result, indent=2))
 
-    elif args.action == 'parse':
-        for event, value in parser.parse():
-            if value is not None:
-                value = parser.convert(event, value)
-            print(event, value)
+        elif args.action == 'load':
+            # Load it all, or only the specified paths or query matches, and
+            # pretty-print the result.
+            print(dumps(load_cli_result(parser, paths, query), indent=2))
+
+        elif args.action == 'parse':
+            for event, value in parser.parse():
+                if value is not None:
+                    value = parser.convert(event, value)
+                print(event, value)
+
+        elif args.action == 'minify' or args.action == 'pretty':
+            import sys
+            writer = Writer(sys.stdout.buffer,
+                            indent=2 if args.action == 'pretty' else None)
+            writer.write(parser.project(include, exclude))
+            writer.write_raw(b'\n')
+            writer.flush()
+
+        elif args.action == 'profile':
+            # Print the per-path statistics.
+            print(dumps(Profiler().run(parser).report(), indent=2))
+
+        elif args.action == 'validate':
+            # Print the stats, or the error and exit with a non-zero status.
+            import sys
+            try:
+                result = dict(parser.validate(), valid=True)
+            except UnexpectedCharacter as e:
+                result = {
+                    'valid': False, 'error': str(e), 'position': e.idx
+                }
+            print(dumps(result))
+            if not result['valid']:
+                sys.exit(1)
+
+        elif args.action == 'split':
+            # Shard the array at the --path, or the top-level array, into
+            # files.
+            if paths and len(paths) > 1:
+                arg_parser.error('Please specify a single --path when using '\
+                                 '--action=split')
+            splitter = Splitter(
+                lambda i: open(args.shard_file.format(i), 'wb'),
+                max_items=args.shard_items,
+                max_bytes=args.shard_bytes,
+                ndjson=args.output == 'ndjson',
+            )
+            num_shards = splitter.run(parser, paths[0] if paths else ())
+            print(dumps({'shards': num_shards}))
@@ -14,8 +14,28 @@ from testy import (
 )
 
 from __init__ import (
+    Aggregator,
+    BYTE_CHARS,
+    ChangeDetector,
+    Dispatcher,
+    HyperLogLog,
+    InvalidQuery,
+    MAGIC_BYTES_LEN,
     Parser,
+    ParserPool,
+    Profiler,
+    ReadAheadReader,
+    RecordSchema,
+    ResultCache,
+    SchemaMismatch,
+    Splitter,
     UnexpectedCharacter,
+    Writer,
+    estimate_size,
+    load_file_ndjson_line,
+    open_decompressed,
+    write_ndjson_events,
+    write_ndjson_results,
 )
 
 ###############################################################################
@@ -195,6 +215,1054 @@ def test_yield_paths():
     ]
     assertEqual(list(parser.yield_paths((path,))), [(path, 41.50324)])
 
+def test_yield_paths_nested_and_empty_containers():
+    parser = Parser(BytesIO(b'{"a": [[1], {}], "b": {}}'))
+    assertEqual(
+        list(parser.yield_paths([['a'], ['b']])),
+        [(['a'], [[1], {}]), (['b'], {})]
+    )
+
+def test_yield_paths_container_and_sub_paths():
+    parser = Parser(BytesIO(b'{"a": {"b": [1, {"c": 2}], "d": 3}, "e": 4}'))
+    assertEqual(
+        list(parser.yield_paths([['a'], ['a', 'b', 1, 'c'], ['a', 'b'],
+                                 ['e']])),
+        [
+            (['a', 'b', 1, 'c'], 2),
+            (['a', 'b'], [1, {'c': 2}]),
+            (['a'], {'b': [1, {'c': 2}], 'd': 3}),
+            (['e'], 4),
+        ]
+    )
+
+def test_yield_paths_root_and_sub_path():
+    parser = Parser(BytesIO(b'[1, [2, 3]]'))
+    assertEqual(list(parser.yield_paths([[], [1, 0]])),
+                [([1, 0], 2), ([], [1, [2, 3]])])
+
+###############################################################################
+# Test skipping and partial loading
+###############################################################################
+
+def test_skip_container():
+    parser = Parser(BytesIO(b'[[1, [2]], {"a": "]"}, 3]'))
+    events = []
+    for event, value, path in parser.yield_path_events():
+        events.append((event, list(path)))
+        if len(path) == 1 and event in ('ARRAY_OPEN', 'OBJECT_OPEN'):
+            parser.skip_container()
+    assertEqual(
+        events,
+        [
+            ('ARRAY_OPEN', []),
+            ('ARRAY_OPEN', [0]),
+            ('OBJECT_OPEN', [1]),
+            ('ARRAY_VALUE_NUMBER', [2]),
+            ('ARRAY_CLOSE', []),
+        ]
+    )
+
+def test_load_include_exclude():
+    _open = lambda: open('test_data/api_weather_gov_points.json', 'rb')
+    data = json.load(_open())
+    expected = {'properties': {
+        'relativeLocation': data['properties']['relativeLocation'],
+    }}
+    del expected['properties']['relativeLocation']['geometry']
+    for buffer_size in (0, 4096):
+        assertEqual(
+            Parser(_open(), buffer_size=buffer_size).load(
+                include=[['properties', 'relativeLocation']],
+                exclude=[['*', '*', 'geometry']]
+            ),
+            expected
+        )
+    assertEqual(
+        Parser(BytesIO(b'[{"a": 1, "b": 2}, {"b": 3}, 4]')).load(
+            include=[['*', 'b']]
+        ),
+        [{'b': 2}, {'b': 3}]
+    )
+    assertEqual(Parser(BytesIO(b'{"a": 1}')).load(exclude=[[]]), None)
+
+
+###############################################################################
+# Test multiple documents
+###############################################################################
+
+def test_load_many():
+    for buffer_size in (0, 1, 4096):
+        parser = Parser(
+            BytesIO(b'{"a": 1}\n[2, {}]\n"x" 3 4.5{"b":[]}[]\n\n'),
+            buffer_size=buffer_size
+        )
+        assertEqual(
+            list(parser.load_many()),
+            [{'a': 1}, [2, {}], 'x', 3, 4.5, {'b': []}, []]
+        )
+
+def test_load_many_empty():
+    assertEqual(list(Parser(BytesIO(b' \n ')).load_many()), [])
+
+def test_load_many_invalid_document():
+    gen = Parser(BytesIO(b'[1]\nx')).load_many()
+    assertEqual(next(gen), [1])
+    assertRaises(UnexpectedCharacter, next, gen)
+
+def test_iter_documents_drains_unconsumed():
+    parser = Parser(BytesIO(b'[1, 2] [3]'))
+    events = [next(parse_gen)[0] for parse_gen in parser.iter_documents()]
+    assertEqual(events, ['ARRAY_OPEN', 'ARRAY_OPEN'])
+
+def test_buffered_parity_with_builtin_json_load():
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    assertEqual(
+        json.load(_open()),
+        Parser(_open(), buffer_size=7).load()
+    )
+
+###############################################################################
+# Test validation
+###############################################################################
+
+def test_validate():
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    size = len(_open().read())
+    for buffer_size in (0, 7, 4096):
+        stats = Parser(_open(), buffer_size=buffer_size).validate()
+        assertEqual(stats['bytes'], size)
+        assertEqual(stats['max_depth'], 3)
+    assertEqual(
+        Parser(BytesIO(b' [1, {"a": [], "b": "x",}, null] ')).validate(),
+        {'bytes': 33, 'values': 6, 'max_depth': 3}
+    )
+
+def test_validate_parity_with_parse():
+    for b in (b'', b'[1,,]', b'{"a" 1}', b'[1] x', b'["a\x01"]', b'nul',
+              b'{"a":1,', b'1.x', b'[1 2]'):
+        for buffer_size in (0, 4):
+            exc = assertRaises(UnexpectedCharacter,
+                               Parser(BytesIO(b), buffer_size=buffer_size)
+                               .validate)
+            assertEqual(str(exc), str(assertRaises(UnexpectedCharacter,
+                                                   parse, b)))
+    exc = assertRaises(UnexpectedCharacter, Parser(BytesIO(b'[1 2]')).validate)
+    assertEqual((exc.char, exc.idx), (b'2', 4))
+
+###############################################################################
+# Test stepping
+###############################################################################
+
+def test_step_max_bytes():
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    expected = json.load(_open())
+    for buffer_size in (0, 4096):
+        parser = Parser(_open(), buffer_size=buffer_size)
+        num_steps = 0
+        while True:
+            char_num = parser.char_num
+            done, value = parser.step(max_bytes=1000)
+            num_steps += 1
+            if done:
+                break
+            assertEqual(value, None)
+            # The budget is only checked between events.
+            assertTrue(1000 <= parser.char_num - char_num < 2000)
+        assertTrue(num_steps > 100)
+        assertEqual(value, expected)
+        # Once done, the result is returned again.
+        assertEqual(parser.step(), (True, expected))
+
+def test_step_max_seconds():
+    parser = Parser(BytesIO(b'{"a": [1, 2, {"b": null}], "c": "d"}'))
+    num_steps = 1
+    while not parser.step(max_seconds=0)[0]:
+        num_steps += 1
+    # Each step parses a single event, including separators.
+    assertEqual(num_steps, 18)
+    assertEqual(parser.step()[1], {'a': [1, 2, {'b': None}], 'c': 'd'})
+    assertEqual(Parser(BytesIO(b' 5 ')).step(max_seconds=0), (True, 5))
+
+def test_step_error_is_raised_again():
+    parser = Parser(BytesIO(b'[1, 2, }'))
+    assertRaises(UnexpectedCharacter, parser.step)
+    # The failed load is not reported as done.
+    assertRaises(UnexpectedCharacter, parser.step)
+
+###############################################################################
+# Test reset and pooling
+###############################################################################
+
+def test_reset():
+    parser = Parser(BytesIO(b'[1, 2'), buffer_size=2)
+    assertRaises(UnexpectedCharacter, parser.load)
+    parser.reset(BytesIO(b'{"a": [3]}'))
+    assertEqual(parser.load(), {'a': [3]})
+    assertEqual(parser.char_num, 10)
+
+def test_parser_pool_reuses_parsers():
+    pool = ParserPool(size=1)
+    parser = pool.acquire(BytesIO(b'1'))
+    assertEqual(parser.load(), 1)
+    pool.release(parser)
+    assertTrue(pool.acquire(BytesIO(b'2')) is parser)
+    # The pool is now empty so a new Parser is returned.
+    assertTrue(pool.acquire(BytesIO(b'3')) is not parser)
+
+def test_parser_pool_reuses_buffers():
+    pool = ParserPool(size=1, new_buffer=lambda: bytearray(4))
+    parser = pool.acquire(BytesIO(b'[1, "two"]'))
+    buffer = parser.fixed_buffer
+    assertEqual(parser.load(), [1, 'two'])
+    pool.release(parser)
+    parser = pool.acquire(BytesIO(b'{"a": 3}'))
+    assertTrue(parser.fixed_buffer is buffer)
+    assertEqual(parser.load(), {'a': 3})
+
+def test_parser_pool_load_from_threads():
+    from threading import Thread
+    pool = ParserPool(size=2, buffer_size=64)
+    results = []
+    def work(i):
+        for _ in range(50):
+            results.append(pool.load(BytesIO(b'{"i": %d}' % i)) == {'i': i})
+    threads = [Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assertEqual(results, [True] * 200)
+
+def test_result_cache():
+    cache = ResultCache()
+    data = b'{"a": [1, 2], "b": "x"}'
+    assertEqual(cache.load(data), {'a': [1, 2], 'b': 'x'})
+    assertEqual(cache.load(bytes(data)), {'a': [1, 2], 'b': 'x'})
+    assertEqual((cache.hits, cache.misses), (1, 1))
+    # yield_paths() results are cached by the requested paths.
+    for _ in range(2):
+        assertEqual(list(cache.yield_paths(data, [['b']])), [(['b'], 'x')])
+    assertEqual(list(cache.yield_paths(data, [['a', 1]])), [(['a', 1], 2)])
+    assertEqual((cache.hits, cache.misses), (2, 3))
+    # The order of the requested paths doesn't matter.
+    expected = [(['a', 1], 2), (['b'], 'x')]
+    assertEqual(list(cache.yield_paths(data, [['a', 1], ['b']])), expected)
+    assertEqual(list(cache.yield_paths(data, [['b'], ['a', 1]])), expected)
+    assertEqual((cache.hits, cache.misses), (3, 4))
+    # Streams require a key.
+    assertRaises(ValueError, cache.load, BytesIO(data))
+    assertEqual(cache.load(BytesIO(b'[]'), key='etag'), [])
+    assertEqual(cache.load(BytesIO(b'[1]'), key='etag'), [])
+
+def test_result_cache_file_key():
+    import os, tempfile
+    fd, file_name = tempfile.mkstemp()
+    try:
+        os.write(fd, b'[1]')
+        os.close(fd)
+        cache = ResultCache()
+        assertEqual(cache.load(file_name), [1])
+        assertEqual(cache.load(file_name), [1])
+        # Changing the file size invalidates the key.
+        with open(file_name, 'wb') as fh:
+            fh.write(b'[1, 2]')
+        assertEqual(cache.load(file_name), [1, 2])
+        assertEqual((cache.hits, cache.misses), (1, 2))
+    finally:
+        os.remove(file_name)
+
+def test_result_cache_lru_eviction():
+    size = estimate_size([0] * 10)
+    cache = ResultCache(max_bytes=size * 2)
+    for key in ('a', 'b', 'a', 'c'):
+        cache.load(BytesIO(json.dumps([0] * 10).encode()), key=key)
+    # b was the least recently used so was evicted.
+    assertEqual([k[1] for k in cache.entries], ['a', 'c'])
+    assertEqual(cache.num_bytes, size * 2)
+    # Results larger than max_bytes are not cached.
+    cache.load(BytesIO(json.dumps([0] * 100).encode()), key='d')
+    assertEqual([k[1] for k in cache.entries], ['a', 'c'])
+
+###############################################################################
+# Test record schemas
+###############################################################################
+
+def test_record_schema_extract():
+    schema = RecordSchema((
+        ('name', str),
+        ('stargazers_count', int),
+        ('fork', bool),
+        ('owner.login', str, 'owner'),
+        ('license.key', str),
+    ))
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    records = list(schema.extract(Parser(_open())))
+    assertEqual(
+        [(r.name, r.stargazers_count, r.fork, r.owner, r.license_key)
+         for r in records],
+        [(d['name'], d['stargazers_count'], d['fork'], d['owner']['login'],
+          d['license'] and d['license']['key'])
+         for d in json.load(_open())]
+    )
+
+def test_record_schema_extract_namedtuple_at_path():
+    from collections import namedtuple
+    Record = namedtuple('Record', ('a', 'b'))
+    schema = RecordSchema((('a', int), ('b', float)), cls=Record)
+    parser = Parser(BytesIO(
+        b'{"x": [1, {"a": [2]}], "y": [{"a": 1, "c": {"b": 2}}, {"b": 3}]}'
+    ))
+    assertEqual(
+        list(schema.extract(parser, ['y'])),
+        [Record(1, None), Record(None, 3.0)]
+    )
+
+def test_record_schema_type_mismatch():
+    schema = RecordSchema((('a', int),))
+    assertRaises(SchemaMismatch, list,
+                 schema.extract(Parser(BytesIO(b'[{"a": 1.5}]'))))
+    assertRaises(SchemaMismatch, list,
+                 schema.extract(Parser(BytesIO(b'[{"a": "1"}]'))))
+    assertRaises(SchemaMismatch, list,
+                 schema.extract(Parser(BytesIO(b'[1]'))))
+
+def test_record_schema_numeric_keys():
+    schema = RecordSchema((('2020', int, 'y2020'), ('stats.007', int, 'bond')))
+    parser = Parser(BytesIO(b'[{"2020": 1, "stats": {"007": 2}}]'))
+    assertEqual([(r.y2020, r.bond) for r in schema.extract(parser)], [(1, 2)])
+    # The default attr name of a numeric key is not an identifier.
+    assertRaises(ValueError, RecordSchema, (('2020', int),))
+
+def test_record_schema_invalid_fields():
+    assertRaises(TypeError, RecordSchema, (('a', list),))
+    assertRaises(ValueError, RecordSchema, ((['a', 0], int),))
+    assertRaises(ValueError, RecordSchema, (('a', int), ('a.b', int)))
+    assertRaises(ValueError, RecordSchema, (('a.b', int), ('a', int)))
+    assertRaises(ValueError, RecordSchema, (('a', int), ('a', str, 'c')))
+
+def test_record_schema_extract_columns():
+    schema = RecordSchema((
+        ('stargazers_count', int),
+        ('license.key', str, 'license'),
+        ('score', float),
+        ('fork', bool),
+    ))
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    columns, null_masks = schema.extract_columns(Parser(_open()))
+    data = json.load(_open())
+    assertEqual(columns['stargazers_count'].typecode, 'q')
+    assertEqual(list(columns['stargazers_count']),
+                [d['stargazers_count'] for d in data])
+    assertEqual(columns['license'],
+                [d['license'] and d['license']['key'] for d in data])
+    assertEqual(list(null_masks['license']),
+                [int(d['license'] is None) for d in data])
+    assertEqual(list(columns['score']), [0.0] * len(data))
+    assertEqual(list(null_masks['score']), [1] * len(data))
+    assertEqual(list(columns['fork']), [int(d['fork']) for d in data])
+
+def test_record_schema_extract_numpy_columns():
+    try:
+        import numpy
+    except ImportError:
+        raise Skip('numpy is not installed')
+    schema = RecordSchema((('a', int), ('b', float)))
+    columns, null_masks = schema.extract_columns(
+        Parser(BytesIO(b'[{"a": 1, "b": 1.5}, {"a": 2}]')),
+        as_numpy=True
+    )
+    assertEqual(columns['a'].dtype, numpy.dtype('int64'))
+    assertEqual(columns['a'].tolist(), [1, 2])
+    assertEqual(null_masks['b'].tolist(), [False, True])
+
+###############################################################################
+# Test checkpoints
+###############################################################################
+
+def test_checkpoint_and_restore():
+    _open = lambda: open('test_data/api_weather_gov_points.json', 'rb')
+    def events(parser):
+        return [
+            (event, value and b''.join(value), list(path))
+            for event, value, path in parser.yield_path_events()
+        ]
+    expected = events(Parser(_open()))
+    for buffer_size in (0, 16):
+        # Checkpoint after each event, simulate an interruption, and resume
+        # using a new parser.
+        for n in range(len(expected) - 1):
+            parser = Parser(_open(), buffer_size=buffer_size)
+            result = []
+            for event, value, path in parser.yield_path_events():
+                result.append((event, value and b''.join(value), list(path)))
+                if len(result) > n:
+                    break
+            checkpoint = json.loads(json.dumps(parser.checkpoint()))
+            parser = Parser(_open(), buffer_size=buffer_size)
+            parser.restore(checkpoint)
+            assertEqual(result + events(parser), expected)
+
+def test_restore_requires_unwrapped_seekable_stream():
+    import gzip
+    data = b'{"a": [10, 20], "b": {"c": 30}}'
+    parser = Parser(BytesIO(data))
+    next(parser.yield_paths([['a', 0]]))
+    checkpoint = parser.checkpoint()
+    for stream, kwargs in (
+        (BytesIO(gzip.compress(data)), {'decompress': True}),
+        (BytesIO(data), {'read_ahead': 1}),
+        (NonSeekableStream(data), {'decompress': True}),
+    ):
+        with Parser(stream, **kwargs) as parser:
+            assertRaises(ValueError, parser.restore, checkpoint)
+    # An uncompressed seekable stream isn't wrapped, so can be restored.
+    parser = Parser(BytesIO(data), decompress=True)
+    parser.restore(checkpoint)
+    assertEqual(list(parser.yield_paths([['b', 'c']])), [(['b', 'c'], 30)])
+
+def test_restore_yield_paths_without_seek():
+    data = b'{"a": [10, 20], "b": {"c": 30}}'
+    parser = Parser(BytesIO(data))
+    gen = parser.yield_paths([['a', 0], ['b', 'c']])
+    assertEqual(next(gen), (['a', 0], 10))
+    checkpoint = parser.checkpoint()
+    # Simulate re-opening the source at the checkpoint offset.
+    parser = Parser(BytesIO(data[checkpoint['offset']:]))
+    parser.restore(checkpoint, seek=False)
+    assertEqual(list(parser.yield_paths([['b', 'c']])), [(['b', 'c'], 30)])
+
+###############################################################################
+# Test queries
+###############################################################################
+
+QUERY_DATA = json.dumps({
+    'features': [
+        {'id': 1, 'type': 'Feature', 'geometry': {'coordinates': [1, 2]}},
+        {'type': 'Other', 'id': 2},
+        {'id': 3, 'x': {'id': 4}, 'type': 'Feature'},
+    ],
+    'id': 0,
+}).encode('utf-8')
+
+def query(q, data=QUERY_DATA):
+    return list(Parser(BytesIO(data)).query(q))
+
+def test_query_exact_path():
+    assertEqual(query('$.features[1].type'),
+                [(['features', 1, 'type'], 'Other')])
+    assertEqual(query("$['features'][0].geometry"),
+                [(['features', 0, 'geometry'], {'coordinates': [1, 2]})])
+
+def test_query_wildcard():
+    assertEqual(
+        query('$.features[*].id'),
+        [(['features', 0, 'id'], 1),
+         (['features', 1, 'id'], 2),
+         (['features', 2, 'id'], 3)]
+    )
+
+def test_query_recursive_descent():
+    assertEqual(
+        query('$..id'),
+        [(['features', 0, 'id'], 1),
+         (['features', 1, 'id'], 2),
+         (['features', 2, 'id'], 3),
+         (['features', 2, 'x', 'id'], 4),
+         (['id'], 0)]
+    )
+
+def test_query_predicate_buffers_preceding_siblings():
+    # The id of the last feature precedes its type, so must be buffered until
+    # the type is seen.
+    assertEqual(
+        query('$.features[?(@.type == "Feature")].id'),
+        [(['features', 0, 'id'], 1), (['features', 2, 'id'], 3)]
+    )
+
+def test_query_predicate_operators():
+    assertEqual(query("$.features[?(@.id >= 2 && @.type != 'Other')].id"),
+                [(['features', 2, 'id'], 3)])
+    assertEqual(query('$.features[?(@.x)].id'), [(['features', 2, 'id'], 3)])
+    assertEqual(query('$.features[?(@.x.id == 4)].x'),
+                [(['features', 2, 'x'], {'id': 4})])
+    assertEqual(query('$[?(@ > 2)]', b'[1, 5, 3, "a"]'), [([1], 5), ([2], 3)])
+
+def test_query_predicate_on_result():
+    assertEqual(
+        query('$.features[?(@.type == "Other")]'),
+        [(['features', 1], {'type': 'Other', 'id': 2})]
+    )
+
+def test_query_recursive_descent_predicate():
+    # Matches within unresolved or unsatisfied candidates must not be lost.
+    assertEqual(query('$..[?(@.a)]', b'{"k": [{"a": 1}]}'),
+                [(['k', 0], {'a': 1})])
+    assertEqual(query('$..[?(@.a)]', b'[[{"a": 1}]]'),
+                [([0, 0], {'a': 1})])
+    assertEqual(query('$..[?(@ == "x")]', b'[{"c": "x"}, null]'),
+                [([0, 'c'], 'x')])
+    assertEqual(
+        query('$..[?(@.a == 1)].b',
+              b'{"a": 1, "b": {"a": 1, "b": [{"a": 2, "b": 3},'
+              b' {"a": 1, "b": 4}]}}'),
+        [(['b', 'b', 1, 'b'], 4),
+         (['b', 'b'], [{'a': 2, 'b': 3}, {'a': 1, 'b': 4}])]
+    )
+
+def test_query_nested_results():
+    # Matches within a matching container are yielded before it.
+    assertEqual(query('$..[?(@.a)]', b'[{"a": {"a": 1}}]'),
+                [([0, 'a'], {'a': 1}), ([0], {'a': {'a': 1}})])
+    assertEqual(
+        query('$..*', b'{"a": [1, {"b": 2}]}'),
+        [(['a', 0], 1),
+         (['a', 1, 'b'], 2),
+         (['a', 1], {'b': 2}),
+         (['a'], [1, {'b': 2}])]
+    )
+
+def test_query_raw_bytes():
+    data = b'{"a": "x", "f": [{"t": "F", "id": 1}, {"t": "G", "id": 2}]}'
+    _query = lambda q: list(Parser(BytesIO(data), encoding=None).query(q))
+    assertEqual(_query('$.a'), [([b'a'], b'x')])
+    assertEqual(_query('$.f[?(@.t == "G")].id'), [([b'f', 1, b'id'], 2)])
+
+def test_invalid_query():
+    for q in ('features', '$.a[', '$.a[?(@.b ==)]', '$.a[?(x)]', '$[?(@'):
+        assertRaises(InvalidQuery, query, q)
+
+###############################################################################
+# Test dispatching
+###############################################################################
+
+def test_dispatcher():
+    calls = []
+    dispatcher = (
+        Dispatcher()
+        .on_value('items.*.id', lambda p, v: calls.append(('id', list(p), v)))
+        .on_enter('items.*', lambda p: calls.append(('enter', list(p))))
+        .on_exit('items.*', lambda p: calls.append(('exit', list(p))))
+        .on_value('meta', lambda p, v: calls.append(('meta', list(p), v)))
+        .on_exit('', lambda p: calls.append(('exit', list(p))))
+    )
+    dispatcher.run(Parser(BytesIO(
+        b'{"x": {"id": 0}, "items": [{"id": 1, "y": [2]}, {"id": 3}, 4],'
+        b' "meta": {"a": [[5]]}}'
+    )))
+    assertEqual(
+        calls,
+        [
+            ('enter', ['items', 0]),
+            ('id', ['items', 0, 'id'], 1),
+            ('exit', ['items', 0]),
+            ('enter', ['items', 1]),
+            ('id', ['items', 1, 'id'], 3),
+            ('exit', ['items', 1]),
+            ('meta', ['meta'], {'a': [[5]]}),
+            ('exit', []),
+        ]
+    )
+
+def test_dispatcher_nested_value_handlers():
+    calls = []
+    append = lambda name: lambda p, v: calls.append((name, list(p), v))
+    dispatcher = (
+        Dispatcher()
+        .on_value('items', append('items'))
+        .on_value('items.*.id', append('id'))
+        .on_value('items.*.*', append('any'))
+        .on_exit('items.*', lambda p: calls.append(('exit', list(p))))
+    )
+    dispatcher.run(Parser(BytesIO(
+        b'{"items": [{"id": 1, "y": [2]}, {"id": 3}], "z": 4}'
+    )))
+    assertEqual(
+        calls,
+        [
+            ('id', ['items', 0, 'id'], 1),
+            ('any', ['items', 0, 'id'], 1),
+            ('any', ['items', 0, 'y'], [2]),
+            ('exit', ['items', 0]),
+            ('id', ['items', 1, 'id'], 3),
+            ('any', ['items', 1, 'id'], 3),
+            ('exit', ['items', 1]),
+            ('items', ['items'], [{'id': 1, 'y': [2]}, {'id': 3}]),
+        ]
+    )
+
+def test_dispatcher_raw_bytes():
+    calls = []
+    dispatcher = (
+        Dispatcher()
+        .on_value('a', lambda p, v: calls.append((list(p), v)))
+        .on_value(['b', '*'], lambda p, v: calls.append((list(p), v)))
+    )
+    dispatcher.run(Parser(BytesIO(b'{"a": "x", "b": {"c": 1}}'),
+                          encoding=None))
+    assertEqual(calls, [([b'a'], b'x'), ([b'b', b'c'], 1)])
+
+def test_dispatcher_parity_with_yield_paths():
+    _open = lambda: open('test_data/api_weather_gov_points.json', 'rb')
+    path = ['properties', 'relativeLocation', 'geometry', 'coordinates', 1]
+    calls = []
+    Dispatcher().on_value(path, lambda p, v: calls.append((list(p), v))).run(
+        Parser(_open())
+    )
+    assertEqual(calls, list(Parser(_open()).yield_paths((path,))))
+
+###############################################################################
+# Test decompression
+###############################################################################
+
+class NonSeekableStream:
+    # A stream wrapper without seek() that returns at most 3 bytes per read.
+    def __init__(self, b):
+        self.fh = BytesIO(b)
+
+    def read(self, size=-1):
+        return self.fh.read(min(size, 3) if size >= 0 else size)
+
+def test_decompress():
+    import bz2, gzip, lzma, zlib
+    _open = lambda: open('test_data/api_weather_gov_points.json', 'rb')
+    data = _open().read()
+    expected = json.load(_open())
+    for compressed in (
+        gzip.compress(data),
+        # Multi-member gzip.
+        gzip.compress(data[:100]) + gzip.compress(data[100:]),
+        zlib.compress(data),
+        bz2.compress(data),
+        lzma.compress(data),
+        # Uncompressed.
+        data,
+    ):
+        for stream_class in (BytesIO, NonSeekableStream):
+            for buffer_size in (0, 4096):
+                parser = Parser(stream_class(compressed),
+                                buffer_size=buffer_size, decompress=True)
+                assertEqual(parser.load(), expected)
+
+def test_decompress_multi_stream_on_chunk_boundary():
+    import bz2, gzip, lzma
+    data = open('test_data/api_weather_gov_points.json', 'rb').read()
+    for compress in (bz2.compress, gzip.compress, lzma.compress):
+        first = compress(data[:100])
+        compressed = first + compress(data[100:])
+        # open_decompressed() passes on the magic bytes as the first chunk,
+        # so make the first stream end exactly at the end of the second.
+        chunk_size = len(first) - MAGIC_BYTES_LEN
+        stream = open_decompressed(BytesIO(compressed), chunk_size)
+        assertEqual(stream.read(), data)
+
+def test_decompress_short_uncompressed_stream():
+    assertEqual(Parser(NonSeekableStream(b'1'), decompress=True).load(), 1)
+
+###############################################################################
+# Test fixed buffers
+###############################################################################
+
+def test_fixed_buffer_parity_with_builtin_json_load():
+    import gzip
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    expected = json.load(_open())
+    buffer = bytearray(7)
+    assertEqual(Parser(_open(), buffer=buffer).load(), expected)
+    # The buffer also works with the decompressing and read-ahead readers.
+    compressed = gzip.compress(_open().read())
+    for read_ahead in (0, 2):
+        parser = Parser(BytesIO(compressed), decompress=True,
+                        read_ahead=read_ahead, buffer=buffer)
+        assertEqual(parser.load(), expected)
+
+def test_fixed_buffer_returns_shared_chars():
+    parser = Parser(BytesIO(b'["a"]'), buffer=bytearray(2))
+    chars = [parser.next_char() for _ in range(6)]
+    assertEqual(chars, [b'[', b'"', b'a', b'"', b']', b''])
+    assertTrue(all(a is b for a, b in zip(chars, [
+        BYTE_CHARS[c] for c in b'["a"]'
+    ])))
+
+###############################################################################
+# Test read-ahead
+###############################################################################
+
+class FailingStream:
+    # A stream that raises an exception after returning its data.
+    def __init__(self, b):
+        self.fh = BytesIO(b)
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if not data:
+            raise IOError('connection reset')
+        return data
+
+def test_read_ahead():
+    import gzip
+    _open = lambda: open('test_data/api_github_com_users_github_repos.json',
+                         'rb')
+    data = _open().read()
+    expected = json.load(_open())
+    for compressed in (gzip.compress(data), data):
+        for buffer_size in (0, 7, 4096):
+            parser = Parser(NonSeekableStream(compressed),
+                            buffer_size=buffer_size, decompress=True,
+                            read_ahead=2)
+            assertEqual(parser.load(), expected)
+
+def test_read_ahead_reader():
+    reader = ReadAheadReader(BytesIO(b'abcdefgh'), chunk_size=3, max_chunks=1)
+    assertEqual(reader.read(2), b'ab')
+    # Reads don't span chunks.
+    assertEqual(reader.read(2), b'c')
+    assertEqual(reader.read(), b'defgh')
+    assertEqual(reader.read(1), b'')
+    # The underlying stream's exceptions are raised by read().
+    reader = ReadAheadReader(FailingStream(b'[1'), chunk_size=1)
+    assertEqual(reader.read(2), b'[')
+    assertEqual(reader.read(2), b'1')
+    assertRaises(IOError, reader.read, 1)
+
+def test_read_ahead_reader_close():
+    # Closing the reader stops the thread, which is otherwise blocked on the
+    # full queue.
+    reader = ReadAheadReader(BytesIO(b'x' * 100), chunk_size=1, max_chunks=1)
+    assertEqual(reader.read(1), b'x')
+    reader.close()
+    assertTrue(not reader.thread.is_alive())
+
+def test_parser_close_stops_read_ahead_thread():
+    import threading
+    data = b'[' + b'1, ' * 10000 + b'1]'
+    num_threads = threading.active_count()
+    for _ in range(5):
+        with Parser(NonSeekableStream(data), buffer_size=16,
+                    read_ahead=1) as parser:
+            for _ in parser.yield_paths([[0]]):
+                break
+    parser = Parser(NonSeekableStream(data), buffer_size=16, read_ahead=1)
+    next(parser.parse())
+    parser.close()
+    assertEqual(threading.active_count(), num_threads)
+
+###############################################################################
+# Test writing
+###############################################################################
+
+def write(b, indent=None, include=None, exclude=None):
+    fh = BytesIO()
+    writer = Writer(fh, indent=indent, buffer_size=16)
+    parser = Parser(BytesIO(b))
+    if include is None and exclude is None:
+        writer.write(parser.parse())
+    else:
+        writer.write(parser.project(include, exclude))
+    writer.flush()
+    return fh.getvalue()
+
+def test_write_minified():
+    assertEqual(
+        write(b'{"a" : [1, -2.5, "x", true, false, null, {}, [],], "b": {}}'),
+        b'{"a":[1,-2.5,"x",true,false,null,{},[]],"b":{}}'
+    )
+
+def test_write_pretty_parity_with_builtin_json_dumps():
+    data = {'a': [1, 'two', {'three': [None, True, False]}], 'b': {}, 'c': []}
+    assertEqual(
+        write(json.dumps(data).encode('utf-8'), indent=2),
+        json.dumps(data, indent=2).encode('utf-8')
+    )
+
+def test_write_preserves_raw_string_bytes():
+    assertEqual(write('["κόσμε"]'.encode('utf-8')), '["κόσμε"]'.encode('utf-8'))
+
+def test_write_include():
+    assertEqual(
+        write(b'[{"id": 1, "x": {"y": 2}}, {"z": [3], "id": 4}]',
+              include=[['*', 'id']]),
+        b'[{"id":1},{"id":4}]'
+    )
+
+def test_write_exclude():
+    assertEqual(
+        write(b'{"a": {"b": [1, {"c": "}]"}], "d": 2}, "e": 3}',
+              exclude=[['a', 'b'], ['e']]),
+        b'{"a":{"d":2}}'
+    )
+
+###############################################################################
+# Test profiling
+###############################################################################
+
+def test_profiler():
+    data = json.dumps({
+        'items': [
+            {'id': 1, 'name': 'ab', 'tags': []},
+            {'id': 2.5, 'name': 'abcd', 'tags': ['x', 'y']},
+            {'id': None, 'name': 'ab'},
+        ],
+    }).encode('utf-8')
+    paths = Profiler().run(Parser(BytesIO(data))).report()['paths']
+    assertEqual(sorted(paths), [
+        '', 'items', 'items.*', 'items.*.id', 'items.*.name',
+        'items.*.tags', 'items.*.tags.*'
+    ])
+    assertEqual(paths['items.*']['count'], 3)
+    assertEqual(paths['items.*']['min_items'], 2)
+    assertEqual(paths['items.*']['max_items'], 3)
+    assertEqual(
+        paths['items.*.id']['types'],
+        {'integer': 1, 'number': 1, 'null': 1}
+    )
+    assertEqual((paths['items.*.id']['min'], paths['items.*.id']['max']),
+                (1, 2.5))
+    name = paths['items.*.name']
+    assertEqual((name['min_bytes'], name['max_bytes']), (2, 4))
+    assertEqual(name['frequent'][0], ['ab', 2])
+    assertEqual(paths['items.*.tags']['count'], 2)
+    assertEqual(paths['items.*.tags']['mean_items'], 1.0)
+
+def test_profiler_bounded_memory():
+    data = json.dumps(
+        {'k{}'.format(i): list(range(100)) for i in range(10)}
+    ).encode('utf-8')
+    report = Profiler(max_paths=5, sample_size=3) \
+        .run(Parser(BytesIO(data))).report()
+    assertEqual(len(report['paths']), 5)
+    # The root, 2 arrays, and their items are tracked.
+    assertEqual(report['untracked'], 8 + 8 * 100)
+    samples = report['paths']['k0.*']['samples']
+    assertEqual(len(samples), 3)
+    assertTrue(all(0 <= x < 100 for x in samples))
+
+###############################################################################
+# Test change detection
+###############################################################################
+
+def diff(detector, data, fingerprint=None):
+    parser = Parser(BytesIO(json.dumps(data).encode('utf-8')))
+    return list(detector.diff(parser, fingerprint))
+
+def test_change_detector():
+    detector = ChangeDetector()
+    old = {'a': [1, 2, 3], 'b': {'c': 'x', 'd': None}, 'e': {'f': [1]}}
+    assertEqual(diff(detector, old), [('added', [])])
+    # The fingerprint is JSON-serializable.
+    fingerprint = json.loads(json.dumps(detector.fingerprint))
+    new = {'b': {'d': None, 'c': 'y'}, 'a': [1, 5], 'e': {'f': [1]}, 'g': 1}
+    assertEqual(diff(detector, new, fingerprint), [
+        ('changed', ['b', 'c']),
+        ('changed', ['a', 1]),
+        ('removed', ['a', 2]),
+        ('added', ['g']),
+    ])
+    # Object key order doesn't matter.
+    reordered = {
+        'g': 1, 'e': {'f': [1]}, 'a': [1, 5], 'b': {'c': 'y', 'd': None}
+    }
+    assertEqual(diff(detector, reordered, detector.fingerprint), [])
+    # Type changes are reported as changes.
+    assertEqual(diff(detector, {**reordered, 'e': [1]}, detector.fingerprint),
+                [('changed', ['e'])])
+
+def test_change_detector_max_depth():
+    detector = ChangeDetector(max_depth=1)
+    diff(detector, {'a': {'b': [1, 2]}, 'c': 3})
+    # Only the root's children are stored.
+    assertEqual(sorted(detector.fingerprint[1]), ['a', 'c'])
+    assertTrue(isinstance(detector.fingerprint[1]['a'], str))
+    assertEqual(
+        diff(detector, {'a': {'b': [1, 3]}, 'c': 3}, detector.fingerprint),
+        [('changed', ['a'])]
+    )
+
+###############################################################################
+# Test aggregation
+###############################################################################
+
+AGGREGATE_DATA = json.dumps({
+    'items': [
+        {'size': 3, 'type': 'a', 'x': {'size': 100}},
+        {'type': 'b', 'size': 5},
+        {'size': 7.5, 'type': 'a'},
+        {'size': None},
+        {'size': 1},
+    ],
+    'other': [{'size': 100}],
+}).encode('utf-8')
+
+def test_aggregator():
+    results = Aggregator() \
+        .add('items', 'items.*', 'count') \
+        .add('count', 'items.*.size', 'count') \
+        .add('sum', 'items.*.size', 'sum') \
+        .add('min', 'items.*.size', 'min') \
+        .add('max', 'items.*.size', 'max') \
+        .add('mean', 'items.*.size', 'mean') \
+        .add('distinct', 'items.*.type', 'distinct') \
+        .run(Parser(BytesIO(AGGREGATE_DATA)))
+    assertEqual(results, {
+        'items': 5,
+        'count': 5,
+        'sum': 16.5,
+        'min': 1,
+        'max': 7.5,
+        'mean': 4.125,
+        'distinct': 2,
+    })
+
+def test_aggregator_group_by():
+    # The group-by field may precede or follow the value.
+    results = Aggregator() \
+        .add('sum', 'items.*.size', 'sum', group_by='type') \
+        .add('count', ['items', '*', 'size'], 'count', group_by=['type']) \
+        .run(Parser(BytesIO(AGGREGATE_DATA)))
+    assertEqual(results, {
+        'sum': {'a': 10.5, 'b': 5, None: 1},
+        'count': {'a': 2, 'b': 1, None: 2},
+    })
+
+def test_hyperloglog():
+    hll = HyperLogLog()
+    for i in range(100000):
+        hll.add(str(i % 50000).encode())
+    assertTrue(abs(hll.count() - 50000) < 50000 * 0.1)
+
+###############################################################################
+# Test splitting
+###############################################################################
+
+class Shard(BytesIO):
+    # A shard stream that keeps its value when closed.
+    def close(self):
+        self.result = self.getvalue()
+
+def split(b, path=(), buffer_size=0, **kwargs):
+    shards = []
+    def open_shard(i):
+        shards.append(Shard())
+        return shards[-1]
+    num_shards = Splitter(open_shard, **kwargs).run(
+        Parser(BytesIO(b), buffer_size=buffer_size), path
+    )
+    assertEqual(num_shards, len(shards))
+    return [shard.result for shard in shards]
+
+def test_splitter_parity_with_builtin_json_load():
+    data = open('test_data/api_github_com_users_github_repos.json',
+                'rb').read()
+    expected = json.loads(data)
+    for buffer_size in (0, 7, 4096):
+        shards = split(data, buffer_size=buffer_size, max_items=7)
+        assertEqual(len(shards), 5)
+        assertEqual(sum((json.loads(s) for s in shards), []), expected)
+        shards = split(data, buffer_size=buffer_size, max_items=7,
+                       ndjson=True)
+        assertEqual(
+            [json.loads(line) for s in shards for line in s.splitlines()],
+            expected
+        )
+
+def test_splitter_copies_raw_bytes():
+    data = (b'{"a": {"b": [1]}, "x": {"items": [1, "s\\n", null, true, '
+            b'[1, {"q": "]"}], {"a": "\\"}"}, 2.50]}}')
+    for buffer_size in (0, 4):
+        assertEqual(
+            split(data, ['x', 'items'], buffer_size, max_bytes=5),
+            [b'[1,"s\\n"]\n', b'[null,true]\n', b'[[1, {"q": "]"}]]\n',
+             b'[{"a": "\\"}"}]\n', b'[2.50]\n']
+        )
+    assertEqual(split(b'{"a": []}', ['a']), [])
+
+###############################################################################
+# Test CLI helpers
+###############################################################################
+
+def test_load_file_ndjson_line():
+    file_name = 'test_data/api_weather_gov_points.json'
+    path = ['properties', 'relativeLocation', 'properties', 'city']
+    assertEqual(
+        json.loads(load_file_ndjson_line((file_name, [path], None))),
+        {'file': file_name,
+         'result': {'properties.relativeLocation.properties.city': 'Beacon'}}
+    )
+    line = load_file_ndjson_line(('test_data/missing.json', None, None))
+    assertTrue(line.endswith(b'\n'))
+    assertTrue('error' in json.loads(line))
+
+def test_write_ndjson_events():
+    fh = BytesIO()
+    writer = Writer(fh, buffer_size=8)
+    write_ndjson_events(writer, Parser(BytesIO(b'[1, {"a": "b"}]')).parse())
+    writer.flush()
+    assertEqual(
+        [json.loads(line) for line in fh.getvalue().splitlines()],
+        [
+            ['ARRAY_OPEN'],
+            ['ARRAY_VALUE_NUMBER', 1],
+            ['OBJECT_OPEN'],
+            ['OBJECT_KEY', 'a'],
+            ['OBJECT_VALUE_STRING', 'b'],
+            ['OBJECT_CLOSE'],
+            ['ARRAY_CLOSE'],
+        ]
+    )
+
+def test_write_ndjson_results():
+    fh = BytesIO()
+    writer = Writer(fh)
+    parser = Parser(BytesIO(b'{"a": [1, {"b": 2}]}'))
+    write_ndjson_results(writer, parser.yield_paths([['a', 1], ['a', 0]]))
+    writer.flush()
+    assertEqual(
+        fh.getvalue(),
+        b'{"path": "a.0", "value": 1}\n{"path": "a.1", "value": {"b": 2}}\n'
+    )
+
+###############################################################################
+# Test raw bytes mode
+###############################################################################
+
+def test_bytes_mode_load():
+    parser = Parser(BytesIO('{"a": ["κόσμε", 1, {"b": null}]}'.encode()),
+                    encoding=None)
+    assertEqual(
+        parser.load(),
+        {b'a': ['κόσμε'.encode(), 1, {b'b': None}]}
+    )
+
+def test_bytes_mode_yield_paths():
+    parser = Parser(BytesIO(b'{"a": {"b": "x"}, "c": "y"}'), encoding=None)
+    assertEqual(
+        list(parser.yield_paths([['a'], ['c']])),
+        [(['a'], {b'b': b'x'}), (['c'], b'y')]
+    )
+
+def test_yield_paths_does_not_decode_unrequested_keys():
+    # The undecodable key is compared as raw bytes and never decoded.
+    parser = Parser(BytesIO(b'{"\xff": 1, "a": {"\xc3\xa9": 2}}'))
+    assertEqual(
+        list(parser.yield_paths([['a', 'é']])),
+        [(['a', 'é'], 2)]
+    )
+
+def test_raw_key_checkpoint_and_restore():
+    data = b'{"\xff": [1, 2], "b": 3}'
+    parser = Parser(BytesIO(data), encoding=None)
+    gen = parser.yield_paths([[b'\xff', 0], [b'b']])
+    assertEqual(next(gen), ([b'\xff', 0], 1))
+    checkpoint = json.loads(json.dumps(parser.checkpoint()))
+    parser = Parser(BytesIO(data), encoding=None)
+    parser.restore(checkpoint)
+    assertEqual(list(parser.yield_paths([[b'\xff', 1], [b'b']])),
+                [([b'\xff', 1], 2), ([b'b'], 3)])
 
 ###############################################################################
 # Test invalid things